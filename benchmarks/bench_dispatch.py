@@ -0,0 +1,109 @@
+"""Сравнение стратегий раздачи заказов курьерам под пиковой нагрузкой.
+
+Заведения создают заказы на 1-5 посылок с пуассоновскими интервалами,
+курьеры сразу принимают предложение и развозят заказы по очереди, тратя
+время пропорционально числу посылок. Для каждой стратегии из
+DISPATCH_STRATEGIES прогоняется одна и та же последовательность заказов
+и печатается время от создания заказа до доставки.
+
+    python benchmarks/bench_dispatch.py [заведений] [курьеров] [заказов на заведение]
+"""
+import asyncio
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import bench_load  # noqa: E402  (настраивает окружение и импортирует бота)
+from bench_load import COURIER_BASE, RESTAURANT_BASE, Driver, StubBot, courier_bot  # noqa: E402
+
+DELIVERY_BASE = 0.05         # секунд на заказ
+DELIVERY_PER_PACKAGE = 0.04  # секунд на посылку
+ARRIVAL_MEAN = 0.35          # средний интервал между заказами одного заведения
+
+
+class Fleet:
+    """Курьеры: принимают всё и доставляют заказы по одному"""
+
+    def __init__(self, driver: Driver, couriers: int):
+        self.driver = driver
+        self.queues = {COURIER_BASE + i: asyncio.Queue() for i in range(couriers)}
+        self.backlog = {courier_id: 0 for courier_id in self.queues}
+        self.max_backlog = 0
+        self.delivery_times = []
+        self.workers = [asyncio.create_task(self._work(courier_id)) for courier_id in self.queues]
+
+    async def take(self, courier_id: int, order_id: str, packages: int, created: float):
+        await self.driver.callback('accept', courier_id, f"accept_{order_id}")
+        self.backlog[courier_id] += packages
+        self.max_backlog = max(self.max_backlog, self.backlog[courier_id])
+        self.queues[courier_id].put_nowait((order_id, packages, created))
+
+    async def _work(self, courier_id: int):
+        queue = self.queues[courier_id]
+        while True:
+            order_id, packages, created = await queue.get()
+            await asyncio.sleep(DELIVERY_BASE + DELIVERY_PER_PACKAGE * packages)
+            await self.driver.callback('delivered', courier_id, f"delivered_{order_id}")
+            self.backlog[courier_id] -= packages
+            self.delivery_times.append(time.perf_counter() - created)
+            queue.task_done()
+
+    async def drain(self):
+        for queue in self.queues.values():
+            await queue.join()
+        for worker in self.workers:
+            worker.cancel()
+
+
+async def restaurant(driver: Driver, fleet: Fleet, bot: StubBot, index: int, orders: int, seed: int):
+    rng = random.Random(seed * 1000 + index)
+    restaurant_id = RESTAURANT_BASE + index
+    name = f"Ресторан {index}"
+    for _ in range(orders):
+        await asyncio.sleep(rng.expovariate(1 / ARRIVAL_MEAN))
+        packages = rng.choice((1, 1, 1, 2, 5, 5))
+        await driver.message('new_order', restaurant_id, "Создать новый заказ")
+        await driver.message('set_time', restaurant_id, "30 мин")
+        await driver.message('set_packages', restaurant_id, str(packages))
+        created = time.perf_counter()
+        for _ in range(packages):
+            await driver.message('set_distance', restaurant_id, "Ближнее")
+        courier_id, order_id = await asyncio.wait_for(bot.offers[name].get(), 10)
+        await fleet.take(courier_id, order_id, packages, created)
+
+
+async def run(strategy: str, bot: StubBot, restaurants: int, couriers: int, orders: int):
+    courier_bot.dispatch_strategy = courier_bot.DISPATCH_STRATEGIES[strategy]
+    courier_bot.courier_load = courier_bot.CourierLoad()
+    driver = Driver(bot)
+    fleet = Fleet(driver, couriers)
+    started = time.perf_counter()
+    await asyncio.gather(*(restaurant(driver, fleet, bot, i, orders, seed=1) for i in range(restaurants)))
+    await fleet.drain()
+    elapsed = time.perf_counter() - started
+    times = sorted(fleet.delivery_times)
+    print(
+        f"{strategy:<13} orders={len(times)} {elapsed:.1f}s  time-to-delivery "
+        f"p50={statistics.median(times) * 1000:.0f}ms p95={bench_load.percentile(times, 0.95) * 1000:.0f}ms "
+        f"max={times[-1] * 1000:.0f}ms  max backlog={fleet.max_backlog} packages"
+    )
+
+
+async def main():
+    restaurants = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    couriers = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    orders = int(sys.argv[3]) if len(sys.argv) > 3 else 30
+    bench_load.logging.disable(bench_load.logging.WARNING)
+    bot = StubBot(os.environ['TELEGRAM_BOT_TOKEN'])
+    courier_bot.bot = bot
+    bench_load.setup(restaurants, couriers)
+    for strategy in courier_bot.DISPATCH_STRATEGIES:
+        await run(strategy, bot, restaurants, couriers, orders)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,201 @@
+"""Сквозной прогон бота против локальной заглушки Bot API.
+
+Бот работает как в проде: настоящий Bot с aiohttp-сессией и long
+polling, только TELEGRAM_API_URL указывает на benchmarks/fake_bot_api.py,
+запущенную в этом же процессе. Заведения проходят сценарий заказа,
+курьеры отвечают на предложения, каждое третье первое предложение
+отклоняется, чтобы задействовать redirect_order.
+
+Для каждого профиля заглушки (задержка, ошибки 5xx, ответы 429)
+печатается время от последнего шага заказа до предложения курьеру
+(send_to_courier), от отказа до следующего предложения (redirect_order)
+и сквозное время заказа.
+
+    python benchmarks/bench_fake_api.py [заведений] [курьеров] [заказов на заведение]
+"""
+import asyncio
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+PORT = 18081
+os.environ.setdefault('TELEGRAM_BOT_TOKEN', '123456:BENCHMARKBENCHMARKBENCHMARKBENCHMAR')
+os.environ['TELEGRAM_API_URL'] = f'http://127.0.0.1:{PORT}'
+os.environ.pop('WEBHOOK_URL', None)
+os.chdir(tempfile.mkdtemp(prefix='bench_fake_api_'))
+
+import courier_bot  # noqa: E402
+from fake_bot_api import FakeBotAPI  # noqa: E402
+
+PROFILES = (
+    ('fast', {}),
+    ('slow', {'latency': 0.1, 'jitter': 0.1}),
+    ('flaky', {'latency': 0.05, 'error_rate': 0.02}),
+    ('throttled', {'latency': 0.05, 'retry_after_rate': 0.05, 'retry_after': 1}),
+)
+RESTAURANT_BASE = 1000000
+COURIER_BASE = 2000000
+STEP_TIMEOUT = 20
+
+
+class Scenario:
+    def __init__(self, api: FakeBotAPI):
+        self.api = api
+        self.inbox = defaultdict(list)  # chat_id -> тексты сообщений бота
+        self.arrived = defaultdict(asyncio.Event)
+        self.waiting = {}  # заведение -> [время отправки последнего шага, отказать ли]
+        self.timings = defaultdict(list)
+        self.failed = 0
+        api.listeners.append(self.on_message)
+
+    def on_message(self, message: dict):
+        text = message.get('text', '')
+        buttons = (message.get('reply_markup') or {}).get('inline_keyboard') or [[{}]]
+        data = buttons[0][0].get('callback_data') or ''
+        if data.startswith('accept_'):
+            self.on_offer(message['chat']['id'], text, data.split('_', 1)[1])
+        else:
+            self.inbox[message['chat']['id']].append(text)
+            self.arrived[message['chat']['id']].set()
+
+    def on_offer(self, courier_id: int, text: str, order_id: str):
+        restaurant = text.split('\n')[1].removeprefix('🏢 ')
+        waiting = self.waiting.get(restaurant)
+        if waiting is None:
+            return
+        self.timings['redirect' if text.startswith('🔄') else 'offer'].append(time.perf_counter() - waiting[0])
+        if waiting[1]:
+            waiting[:] = [time.perf_counter(), False]
+            self.push_callback(courier_id, f"decline_{order_id}")
+        else:
+            del self.waiting[restaurant]
+            self.push_callback(courier_id, f"accept_{order_id}")
+
+    def push_message(self, user_id: int, text: str):
+        self.api.push_update({'message': {
+            'message_id': 1,
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'user{user_id}'},
+            'text': text
+        }})
+
+    def push_callback(self, user_id: int, data: str):
+        self.api.push_update({'callback_query': {
+            'id': data,
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'user{user_id}', 'username': f'user{user_id}'},
+            'chat_instance': str(user_id),
+            'data': data,
+            'message': {
+                'message_id': 1,
+                'date': int(time.time()),
+                'chat': {'id': user_id, 'type': 'private'},
+                'text': 'offer'
+            }
+        }})
+
+    async def expect(self, chat_id: int, prefix: str) -> str:
+        """Ждёт сообщение бота в чат, начинающееся с prefix.
+
+        Сообщения из исходящей очереди могут обогнать прямые ответы,
+        поэтому остальные сообщения остаются во входящих.
+        """
+        deadline = time.perf_counter() + STEP_TIMEOUT
+        inbox = self.inbox[chat_id]
+        while True:
+            for index, text in enumerate(inbox):
+                if text.startswith(prefix):
+                    return inbox.pop(index)
+            self.arrived[chat_id].clear()
+            await asyncio.wait_for(self.arrived[chat_id].wait(), max(0.0, deadline - time.perf_counter()))
+
+    async def order(self, restaurant_id: int, restaurant: str, decline: bool):
+        started = time.perf_counter()
+        try:
+            for text, reply in (("Создать новый заказ", "⏰"), ("30 мин", "📦"), ("2", "📍"), ("Ближнее", "📍")):
+                self.push_message(restaurant_id, text)
+                await self.expect(restaurant_id, reply)
+            self.waiting[restaurant] = [time.perf_counter(), decline]
+            self.push_message(restaurant_id, "Дальнее")
+            await self.expect(restaurant_id, "✅ Заказ создан")
+            text = await self.expect(restaurant_id, "✅ Заказ")
+            order_id, courier = text.removeprefix('✅ Заказ ').split(' принят курьером @user')
+            self.push_callback(int(courier), f"delivered_{order_id}")
+            await self.expect(restaurant_id, f"🚚 Заказ {order_id}")
+        except asyncio.TimeoutError:
+            self.waiting.pop(restaurant, None)
+            self.inbox[restaurant_id].clear()
+            self.failed += 1
+            return
+        self.timings['order'].append(time.perf_counter() - started)
+
+    async def restaurant(self, index: int, orders: int):
+        for number in range(orders):
+            await self.order(RESTAURANT_BASE + index, f"Ресторан {index}", (index + number) % 3 == 0)
+
+
+def setup(restaurants: int, couriers: int):
+    for i in range(restaurants):
+        courier_bot.save_restaurant(RESTAURANT_BASE + i, f"Ресторан {i}", '100/200')
+    for i in range(couriers):
+        courier_bot.save_courier(COURIER_BASE + i, f"Курьер {i}")
+        courier_bot.add_active_courier(COURIER_BASE + i)
+
+
+def percentile(values: list, fraction: float) -> float:
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+async def run_profile(api: FakeBotAPI, name: str, settings: dict, restaurants: int, orders: int):
+    api.latency = settings.get('latency', 0.0)
+    api.jitter = settings.get('jitter', 0.0)
+    api.error_rate = settings.get('error_rate', 0.0)
+    api.retry_after_rate = settings.get('retry_after_rate', 0.0)
+    api.retry_after = settings.get('retry_after', 1)
+    api.injected.clear()
+    scenario = Scenario(api)
+    started = time.perf_counter()
+    await asyncio.gather(*(scenario.restaurant(i, orders) for i in range(restaurants)))
+    elapsed = time.perf_counter() - started
+    api.listeners.remove(scenario.on_message)
+    done = len(scenario.timings['order'])
+    print(f"\n{name}: {done} orders in {elapsed:.1f}s ({done / elapsed:.1f}/s), "
+          f"{scenario.failed} timed out, injected {dict(api.injected)}")
+    for step in ('offer', 'redirect', 'order'):
+        values = sorted(scenario.timings[step])
+        if values:
+            print(
+                f"  {step:<9} n={len(values):<4} p50={statistics.median(values) * 1000:7.1f}ms "
+                f"p95={percentile(values, 0.95) * 1000:7.1f}ms max={values[-1] * 1000:7.1f}ms"
+            )
+
+
+async def main():
+    restaurants = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    couriers = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    orders = int(sys.argv[3]) if len(sys.argv) > 3 else 6
+    logging.disable(logging.CRITICAL)
+    api = FakeBotAPI(seed=1)
+    runner = await api.start(port=PORT)
+    setup(restaurants, couriers)
+    polling = asyncio.create_task(courier_bot.dp.start_polling(courier_bot.bot, handle_signals=False))
+    try:
+        for name, settings in PROFILES:
+            await run_profile(api, name, settings, restaurants, orders)
+        print(f"\nBot API calls: {dict(api.calls)}")
+        print(f"outbound: {courier_bot.outbound.stats()} errors {courier_bot.send_errors.values}")
+    finally:
+        await courier_bot.dp.stop_polling()
+        await polling
+        await runner.cleanup()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
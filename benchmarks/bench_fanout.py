@@ -0,0 +1,133 @@
+"""Время до принятия заказа: предложение одному курьеру против рассылки K курьерам.
+
+Курьеры отвечают на предложение через случайное время: часть отказывается,
+часть молчит до истечения ACCEPT_TIMEOUT, остальные принимают. При
+OFFER_FANOUT > 1 заказ уходит сразу нескольким курьерам, выигрывает первый
+accept_, а сообщения остальных снимаются. Для каждого K печатается время
+от создания заказа до принятия и число отправленных и снятых предложений.
+
+    python benchmarks/bench_fanout.py [заведений] [курьеров] [заказов на заведение] [K,K,...]
+"""
+import asyncio
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import bench_load  # noqa: E402  (настраивает окружение и импортирует бота)
+from bench_load import RESTAURANT_BASE, Driver, StubBot, courier_bot  # noqa: E402
+
+RESPONSE_MEAN = 0.3   # среднее время, за которое курьер замечает предложение
+DECLINE_RATE = 0.3
+IGNORE_RATE = 0.15
+ACCEPT_TIMEOUT = 1.0  # вместо 300 секунд в боте
+REDIRECT_BACKOFF = 0.05  # в том же масштабе, что и ACCEPT_TIMEOUT
+ARRIVAL_MEAN = 0.3    # средний интервал между заказами одного заведения
+ADMIN_ID = 3000000
+
+
+class Couriers:
+    """Отвечают на предложения, пока те не сняты ботом"""
+
+    def __init__(self, driver: Driver, seed: int):
+        self.driver = driver
+        self.rng = random.Random(seed)
+        self.offered = {}  # order_id -> время первого предложения
+        self.times = []
+        self.sent = 0
+        self.stale = 0
+        self.tasks = set()
+
+    def offer(self, courier_id: int, order_id: str):
+        self.sent += 1
+        self.offered.setdefault(order_id, time.perf_counter())
+        task = asyncio.create_task(self._respond(courier_id, order_id))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _respond(self, courier_id: int, order_id: str):
+        await asyncio.sleep(self.rng.expovariate(1 / RESPONSE_MEAN))
+        if courier_id not in courier_bot.offer_board.offers.get(order_id, {}):
+            self.stale += 1  # предложение уже снято: кнопок у курьера нет
+            return
+        roll = self.rng.random()
+        if roll < IGNORE_RATE:
+            return
+        if roll < IGNORE_RATE + DECLINE_RATE:
+            await self.driver.callback('decline', courier_id, f"decline_{order_id}")
+            return
+        await self.driver.callback('accept', courier_id, f"accept_{order_id}")
+        record = courier_bot.order_store.get(order_id)
+        if record['status'] == 'accepted' and record['courier_id'] == str(courier_id):
+            self.times.append(time.perf_counter() - self.offered[order_id])
+
+    async def settle(self, timeout: float = 30):
+        """Ждёт, пока у заказов не останется открытых предложений и отложенных перенаправлений"""
+        deadline = time.perf_counter() + timeout
+        while (courier_bot.offer_board.offers or courier_bot.acceptance_timers or self.tasks) \
+                and time.perf_counter() < deadline:
+            await asyncio.sleep(0.05)
+
+
+async def offers(bot: StubBot, couriers: Couriers, name: str):
+    queue = bot.offers[name]
+    while True:
+        courier_id, order_id = await queue.get()
+        couriers.offer(courier_id, order_id)
+
+
+async def restaurant(driver: Driver, index: int, orders: int, seed: int):
+    rng = random.Random(seed * 1000 + index)
+    restaurant_id = RESTAURANT_BASE + index
+    for _ in range(orders):
+        await asyncio.sleep(rng.expovariate(1 / ARRIVAL_MEAN))
+        await driver.message('new_order', restaurant_id, "Создать новый заказ")
+        await driver.message('set_time', restaurant_id, "30 мин")
+        await driver.message('set_packages', restaurant_id, "1")
+        await driver.message('set_distance', restaurant_id, "Ближнее")
+
+
+async def run(fanout: int, bot: StubBot, restaurants: int, orders: int):
+    courier_bot.OFFER_FANOUT = fanout
+    courier_bot.courier_load = courier_bot.CourierLoad()
+    courier_bot.offer_board = courier_bot.OfferBoard()
+    driver = Driver(bot)
+    couriers = Couriers(driver, seed=1)
+    edited = bot.calls['EditMessageText']
+    readers = [asyncio.create_task(offers(bot, couriers, f"Ресторан {i}")) for i in range(restaurants)]
+    started = time.perf_counter()
+    await asyncio.gather(*(restaurant(driver, i, orders, seed=1) for i in range(restaurants)))
+    await couriers.settle()
+    elapsed = time.perf_counter() - started
+    for reader in readers:
+        reader.cancel()
+    times = sorted(couriers.times)
+    print(
+        f"K={fanout:<2} accepted={len(times)}/{len(couriers.offered)} {elapsed:.1f}s  time-to-accept "
+        f"p50={statistics.median(times) * 1000:.0f}ms p95={bench_load.percentile(times, 0.95) * 1000:.0f}ms "
+        f"max={times[-1] * 1000:.0f}ms  offers={couriers.sent} "
+        f"retracted={bot.calls['EditMessageText'] - edited} stale={couriers.stale}"
+    )
+
+
+async def main():
+    restaurants = int(sys.argv[1]) if len(sys.argv) > 1 else 6
+    couriers = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    orders = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+    fanouts = [int(k) for k in sys.argv[4].split(',')] if len(sys.argv) > 4 else [1, 2, 3]
+    bench_load.logging.disable(bench_load.logging.WARNING)
+    bot = StubBot(os.environ['TELEGRAM_BOT_TOKEN'])
+    courier_bot.bot = bot
+    bench_load.setup(restaurants, couriers)
+    courier_bot.directory.set_admin(ADMIN_ID)
+    courier_bot.ACCEPT_TIMEOUT = ACCEPT_TIMEOUT
+    courier_bot.REDIRECT_BACKOFF = REDIRECT_BACKOFF
+    for fanout in fanouts:
+        await run(fanout, bot, restaurants, orders)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,99 @@
+"""Стоимость смены состояния FSM и память: MemoryStorage против SQLiteFSMStorage.
+
+Каждый пользователь проходит шаги мастера заказа (время, посылки,
+расстояния) через FSMContext, после чего часть мастеров бросается
+незаконченными. Для растущего числа пользователей печатается время на
+одну смену состояния и прирост памяти (tracemalloc). В конце проверяется,
+что после «перезапуска» (новое хранилище на той же базе) брошенные мастера
+продолжаются с того же шага, а устаревшие удаляются sweep().
+
+    python benchmarks/bench_fsm.py [пользователей,пользователей,...]
+"""
+import asyncio
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault('TELEGRAM_BOT_TOKEN', '123456:BENCHMARKBENCHMARKBENCHMARKBENCHMAR')
+os.chdir(tempfile.mkdtemp(prefix='bench_fsm_'))
+
+import courier_bot  # noqa: E402
+from aiogram.fsm.context import FSMContext  # noqa: E402
+from aiogram.fsm.storage.base import StorageKey  # noqa: E402
+from aiogram.fsm.storage.memory import MemoryStorage  # noqa: E402
+
+BOT_ID = 123456
+USER_BASE = 5000000
+
+
+def context(fsm_storage, user_id: int) -> FSMContext:
+    key = StorageKey(bot_id=BOT_ID, chat_id=user_id, user_id=user_id)
+    return FSMContext(bot=courier_bot.bot, storage=fsm_storage, key=key)
+
+
+async def wizard(state: FSMContext, finish: bool) -> int:
+    """Шаги мастера заказа, как в обработчиках Form; возвращает число смен состояния"""
+    await state.set_state(courier_bot.Form.time)
+    await state.update_data(time='30 мин')
+    await state.set_state(courier_bot.Form.packages)
+    await state.update_data(packages=3, current_package=1, distances=[])
+    await state.set_state(courier_bot.Form.distance)
+    await state.update_data(distances=['Ближнее'], current_package=2)
+    await state.update_data(distances=['Ближнее', 'Дальнее'], current_package=3)
+    if finish:
+        await state.get_data()
+        await state.clear()
+        return 8
+    return 7
+
+
+async def bench(name: str, fsm_storage, users: int):
+    tracemalloc.start()
+    started = time.perf_counter()
+    changes = 0
+    for i in range(users):
+        changes += await wizard(context(fsm_storage, USER_BASE + i), finish=i % 4 != 0)
+    if hasattr(fsm_storage, 'flush'):
+        await fsm_storage.flush()
+    elapsed = time.perf_counter() - started
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(
+        f"{name:<8} users={users:<7} {elapsed / changes * 1e6:>6.1f} us/change  "
+        f"memory={current / 1024 / 1024:>6.1f} MB"
+    )
+
+
+async def check_restart(db_path: str, users: int):
+    fsm_storage = courier_bot.SQLiteFSMStorage(sqlite3.connect(db_path, check_same_thread=False))
+    abandoned = 0
+    for i in range(0, users, 4):
+        state = context(fsm_storage, USER_BASE + i)
+        if await state.get_state() == courier_bot.Form.distance.state:
+            data = await state.get_data()
+            abandoned += data['current_package'] == 3
+    print(f"restart  {abandoned}/{len(range(0, users, 4))} abandoned wizards resumed at Form.distance")
+    fsm_storage.ttl = 0
+    removed = await fsm_storage.sweep()
+    print(f"sweep    {removed} stale states removed, {fsm_storage.stats()}")
+
+
+async def main():
+    sizes = [int(n) for n in sys.argv[1].split(',')] if len(sys.argv) > 1 else [1000, 10000, 50000]
+    courier_bot.logging.disable(courier_bot.logging.WARNING)
+    for users in sizes:
+        await bench('memory', MemoryStorage(), users)
+        db_path = f"fsm_{users}.db"
+        fsm_storage = courier_bot.SQLiteFSMStorage(sqlite3.connect(db_path, check_same_thread=False))
+        await bench('sqlite', fsm_storage, users)
+        print(f"         {fsm_storage.stats()}")
+    await check_restart(db_path, sizes[-1])
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
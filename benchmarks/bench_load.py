@@ -0,0 +1,185 @@
+"""Синтетическая нагрузка на dp с заглушкой вместо Telegram.
+
+N заведений параллельно проходят полный сценарий заказа: "Создать новый
+заказ" -> set_time -> set_packages -> set_distance (create_order) ->
+курьер принимает -> курьер отмечает доставку. M курьеров на смене.
+StubBot записывает вызовы Bot API и передаёт предложения заказов
+курьерам. Лимиты исходящей очереди сняты, чтобы мерить сам бот.
+
+Прогон повторяется на растущей истории заказов, чтобы видеть, как
+пропускная способность и задержки зависят от её размера.
+
+    python benchmarks/bench_load.py [заведений] [курьеров] [заказов на заведение]
+"""
+import asyncio
+import logging
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault('TELEGRAM_BOT_TOKEN', '123456:BENCHMARKBENCHMARKBENCHMARKBENCHMAR')
+os.chdir(tempfile.mkdtemp(prefix='bench_load_'))
+
+import courier_bot  # noqa: E402
+from aiogram import Bot, methods, types  # noqa: E402
+
+HISTORY_SIZES = (0, 10000, 100000, 500000)
+RESTAURANT_BASE = 1000000
+COURIER_BASE = 2000000
+
+
+class StubBot(Bot):
+    """Bot, который ничего не отправляет, а только считает вызовы"""
+
+    def __init__(self, token: str):
+        super().__init__(token=token)
+        self.calls = Counter()
+        self.offers = defaultdict(asyncio.Queue)  # заведение -> (курьер, id заказа)
+        self.message_id = 0
+
+    async def __call__(self, method, request_timeout=None):
+        self.calls[type(method).__name__] += 1
+        if isinstance(method, methods.SendMessage):
+            markup = method.reply_markup
+            if isinstance(markup, types.InlineKeyboardMarkup):
+                data = markup.inline_keyboard[0][0].callback_data or ''
+                if data.startswith('accept_'):
+                    restaurant = method.text.split('\n')[1].removeprefix('🏢 ')
+                    self.offers[restaurant].put_nowait((method.chat_id, data.split('_', 1)[1]))
+            self.message_id += 1
+            return types.Message(
+                message_id=self.message_id,
+                date=datetime.now(),
+                chat=types.Chat(id=method.chat_id, type='private'),
+                text=method.text
+            )
+        return True
+
+
+class Driver:
+    def __init__(self, bot: StubBot):
+        self.bot = bot
+        self.update_id = 0
+        self.latencies = defaultdict(list)
+
+    def _user(self, user_id: int) -> dict:
+        return {'id': user_id, 'is_bot': False, 'first_name': f'user{user_id}', 'username': f'user{user_id}'}
+
+    async def _feed(self, step: str, update: dict):
+        self.update_id += 1
+        update['update_id'] = self.update_id
+        started = time.perf_counter()
+        await courier_bot.dp.feed_update(self.bot, types.Update(**update))
+        self.latencies[step].append(time.perf_counter() - started)
+
+    async def message(self, step: str, user_id: int, text: str):
+        await self._feed(step, {'message': {
+            'message_id': self.update_id,
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': self._user(user_id),
+            'text': text
+        }})
+
+    async def callback(self, step: str, user_id: int, data: str):
+        await self._feed(step, {'callback_query': {
+            'id': str(self.update_id),
+            'from': self._user(user_id),
+            'chat_instance': str(user_id),
+            'data': data,
+            'message': {
+                'message_id': self.update_id,
+                'date': int(time.time()),
+                'chat': {'id': user_id, 'type': 'private'},
+                'text': 'offer'
+            }
+        }})
+
+    async def restaurant(self, restaurant_id: int, restaurant: str, orders: int):
+        for _ in range(orders):
+            await self.order(restaurant_id, restaurant)
+
+    async def order(self, restaurant_id: int, restaurant: str):
+        await self.message('new_order', restaurant_id, "Создать новый заказ")
+        await self.message('set_time', restaurant_id, "30 мин")
+        await self.message('set_packages', restaurant_id, "2")
+        await self.message('set_distance', restaurant_id, "Ближнее")
+        await self.message('create_order', restaurant_id, "Дальнее")
+        courier_id, order_id = await asyncio.wait_for(self.bot.offers[restaurant].get(), 10)
+        await self.callback('accept', courier_id, f"accept_{order_id}")
+        await self.callback('delivered', courier_id, f"delivered_{order_id}")
+
+
+def setup(restaurants: int, couriers: int):
+    for i in range(restaurants):
+        courier_bot.save_restaurant(RESTAURANT_BASE + i, f"Ресторан {i}", '100/200')
+    for i in range(couriers):
+        courier_bot.save_courier(COURIER_BASE + i, f"Курьер {i}")
+        courier_bot.add_active_courier(COURIER_BASE + i)
+    courier_bot.CHAT_SEND_RATE = courier_bot.CHAT_SEND_BURST = 1e9
+    courier_bot.outbound.global_bucket = courier_bot.TokenBucket(1e9, 1e9)
+
+
+def grow_history(target: int, restaurants: int, couriers: int):
+    """Дописывает в таблицу заказов старую историю до target строк"""
+    current = courier_bot.conn.execute("SELECT COUNT(*) FROM orders WHERE id LIKE 'H%'").fetchone()[0]
+    today = datetime.now(courier_bot.TIME_ZONE)
+    rows = []
+    for i in range(current, target):
+        day = (today - timedelta(days=random.randint(1, 365))).strftime('%Y-%m-%d')
+        rows.append((
+            f"H{i}", RESTAURANT_BASE + random.randrange(restaurants), f"Ресторан {i % restaurants}",
+            '30 мин', 2, 'Ближнее, Дальнее', 300, random.choice(['accepted', 'delivered', 'declined']),
+            day, '12:00:00', COURIER_BASE + random.randrange(couriers)
+        ))
+    courier_bot.conn.executemany('INSERT INTO orders VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+    courier_bot.conn.commit()
+    # Строки вставлены мимо OrderStore: перечитываем его кэш, индекс заведений и агрегаты
+    courier_bot.order_store.resync()
+
+
+def percentile(values: list, fraction: float) -> float:
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+async def run_round(bot: StubBot, history: int, restaurants: int, orders: int):
+    driver = Driver(bot)
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        driver.restaurant(RESTAURANT_BASE + i, f"Ресторан {i}", orders)
+        for i in range(restaurants)
+    ))
+    elapsed = time.perf_counter() - started
+    total = restaurants * orders
+    print(f"\nhistory={history} orders={total} {total / elapsed:.0f} orders/s ({elapsed:.2f}s)")
+    for step, values in driver.latencies.items():
+        values.sort()
+        print(
+            f"  {step:<13} p50={statistics.median(values) * 1000:6.2f}ms "
+            f"p95={percentile(values, 0.95) * 1000:6.2f}ms p99={percentile(values, 0.99) * 1000:6.2f}ms"
+        )
+
+
+async def main():
+    restaurants = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    couriers = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    orders = int(sys.argv[3]) if len(sys.argv) > 3 else 10
+    logging.disable(logging.WARNING)
+    bot = StubBot(os.environ['TELEGRAM_BOT_TOKEN'])
+    courier_bot.bot = bot
+    setup(restaurants, couriers)
+    for history in HISTORY_SIZES:
+        grow_history(history, restaurants, couriers)
+        await run_round(bot, history, restaurants, orders)
+    print(f"\nBot API calls: {dict(bot.calls)}")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
\ No newline at end of file
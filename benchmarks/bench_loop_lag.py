@@ -0,0 +1,95 @@
+"""Задержка цикла событий под синтетической нагрузкой отчётами.
+
+Сравнивает выполнение запросов отчёта прямо в цикле событий (как было
+раньше) с выполнением через поток хранилища (storage.run). Пока идёт
+нагрузка, пробник каждые 5 мс засыпает и замеряет опоздание.
+
+    python benchmarks/bench_loop_lag.py [заказов] [отчётов]
+"""
+import asyncio
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault('TELEGRAM_BOT_TOKEN', '123456:BENCHMARKBENCHMARKBENCHMARKBENCHMAR')
+os.chdir(tempfile.mkdtemp(prefix='bench_loop_lag_'))
+
+import courier_bot  # noqa: E402
+
+
+def populate(count: int):
+    today = datetime.now(courier_bot.TIME_ZONE)
+    rows = []
+    for i in range(count):
+        day = (today - timedelta(days=random.randint(0, 6))).strftime('%Y-%m-%d')
+        courier_id = random.randint(1, 50)
+        rows.append((
+            f"Заказ #{i}", random.randint(1, 200), f"Ресторан {random.randint(1, 200)}", '30 мин',
+            2, 'Ближнее, Дальнее', 13, random.choice(['accepted', 'delivered', 'declined']),
+            day, '12:00:00', courier_id
+        ))
+    courier_bot.conn.executemany('INSERT INTO orders VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+    courier_bot.conn.commit()
+    courier_bot.order_stats.rebuild(
+        courier_bot.order_from_row(row) for row in courier_bot.conn.execute('SELECT * FROM orders')
+    )
+
+
+async def probe(lags: list, stop: asyncio.Event, interval: float = 0.005):
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        started = loop.time()
+        await asyncio.sleep(interval)
+        lags.append(max(0.0, loop.time() - started - interval))
+
+
+async def run_inline(func, *args, **kwargs):
+    """Прежнее поведение: блокирующий вызов прямо в цикле событий"""
+    return func(*args, **kwargs)
+
+
+async def inline_report():
+    threaded_run = courier_bot.storage.run
+    courier_bot.storage.run = run_inline
+    try:
+        return await courier_bot.generate_report()
+    finally:
+        courier_bot.storage.run = threaded_run
+
+
+async def run(name: str, report, reports: int):
+    lags = []
+    stop = asyncio.Event()
+    probe_task = asyncio.create_task(probe(lags, stop))
+    await asyncio.sleep(0.05)
+    started = time.perf_counter()
+    await asyncio.gather(*(report() for _ in range(reports)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await probe_task
+    lags.sort()
+    p99 = lags[int(len(lags) * 0.99) - 1] if lags else 0.0
+    print(
+        f"{name:<8} reports={reports} total={elapsed:.2f}s "
+        f"lag median={statistics.median(lags) * 1000:.1f}ms "
+        f"p99={p99 * 1000:.1f}ms max={lags[-1] * 1000:.1f}ms"
+    )
+
+
+async def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    reports = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    populate(count)
+    print(f"orders in table: {count}")
+    await run('inline', inline_report, reports)
+    await run('storage', courier_bot.generate_report, reports)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
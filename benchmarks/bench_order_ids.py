@@ -0,0 +1,72 @@
+"""Сравнение старого order_id_generator с OrderIdAllocator.
+
+Запуск из корня репозитория:
+
+    python benchmarks/bench_order_ids.py [количество номеров]
+
+Скрипт работает во временном каталоге и не трогает файлы бота.
+"""
+import os
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault('TELEGRAM_BOT_TOKEN', '123456:BENCHMARKBENCHMARKBENCHMARKBENCHMAR')
+os.chdir(tempfile.mkdtemp(prefix='bench_order_ids_'))
+
+import courier_bot  # noqa: E402
+
+
+def legacy_order_id_generator(filename: str):
+    """Прежняя реализация: чтение и перезапись счётчика на каждый заказ"""
+    try:
+        counter = int(courier_bot.file_operation(filename, 'r') or 0)
+    except ValueError:
+        counter = 0
+    counter += 1
+    courier_bot.file_operation(filename, 'w', counter)
+    return f"Заказ #{counter}"
+
+
+def bench(name: str, func, count: int):
+    started = time.perf_counter()
+    for _ in range(count):
+        func()
+    elapsed = time.perf_counter() - started
+    print(f"{name:<12} {count / elapsed:>12.0f} ids/s   {elapsed / count * 1e6:>8.2f} us/id")
+
+
+def check_concurrency(threads: int = 8, per_thread: int = 2000):
+    allocator = courier_bot.OrderIdAllocator('counter_concurrent.txt')
+    issued = []
+
+    def worker():
+        local = [allocator.next() for _ in range(per_thread)]
+        issued.extend(local)
+
+    pool = [threading.Thread(target=worker) for _ in range(threads)]
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    assert len(set(issued)) == threads * per_thread, "duplicate ids under concurrency"
+
+    # Имитация сбоя: новый экземпляр читает только зарезервированную границу
+    restarted = courier_bot.OrderIdAllocator('counter_concurrent.txt')
+    assert restarted.next() > max(issued), "id reused after restart"
+    print(f"concurrency  {threads}x{per_thread} ids unique, monotonic after restart")
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    bench('legacy', lambda: legacy_order_id_generator('counter_legacy.txt'), count)
+    allocator = courier_bot.OrderIdAllocator('counter_blocks.txt')
+    bench('allocator', lambda: f"Заказ #{allocator.next()}", count)
+    check_concurrency()
+
+
+if __name__ == '__main__':
+    main()
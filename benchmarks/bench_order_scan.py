@@ -0,0 +1,167 @@
+"""Разбор строк заказов: построчный split в str против разбора bytes.
+
+Генерирует журнал заказов на несколько миллионов строк (новые заказы,
+смены статуса, удаления) и в отдельных процессах, чтобы пиковый RSS
+не смешивался, прогоняет:
+
+  archive  свод по заведениям и курьерам (посылки, сумма, доставлено) по
+           разделу архива, сжатому тем же журналом: прежний read_archive
+           (gzip в текстовом режиме, split каждой строки в 11 строк)
+           против OrderStore.read_archive со scan_orders и полями
+           ORDER_STATS_FIELDS, как при пересборке агрегатов;
+  import   перенос журнала в таблицу orders: прежнее чтение всего
+           журнала в dict против import_orders_file с mmap и смещениями.
+
+    python benchmarks/bench_order_scan.py [строк]
+"""
+import gzip
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault('TELEGRAM_BOT_TOKEN', '123456:BENCHMARKBENCHMARKBENCHMARKBENCHMAR')
+
+STATUSES = ('pending', 'accepted', 'delivered', 'delivered', 'delivered', 'declined')
+
+
+def generate(path: str, lines: int):
+    rng = random.Random(1)
+    order_id = 0
+    with open(path, 'w', encoding='utf-8') as f:
+        for _ in range(lines):
+            roll = rng.random()
+            if roll < 0.7 or order_id < 100:
+                order_id += 1
+                current, status = order_id, 'pending'
+            else:
+                current = rng.randint(max(1, order_id - 1000), order_id)
+                status = 'removed' if roll > 0.97 else rng.choice(STATUSES)
+            restaurant = rng.randint(1, 300)
+            f.write(
+                f"Заказ #{current}|{1000000 + restaurant}|Ресторан {restaurant}|30 мин|{rng.randint(1, 5)}|"
+                f"Ближнее, Дальнее|{rng.randint(7, 40)}|{status}|2024-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}|"
+                f"12:{rng.randint(0, 59):02d}:00|{rng.randint(1, 60) if status != 'pending' else 'None'}\n"
+            )
+
+
+def rss_mb() -> float:
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def add(totals: dict, record: dict):
+    restaurant = totals.setdefault(('restaurant', record['restaurant']), [0, 0, 0])
+    courier = totals.setdefault(('courier', record['courier_id']), [0, 0, 0])
+    for bucket in (restaurant, courier):
+        bucket[0] += record['packages']
+        bucket[1] += record['price']
+        if record['status'] == 'delivered':
+            bucket[2] += record['packages']
+
+
+def archive_legacy(courier_bot, path: str) -> int:
+    """Прежний read_archive: записи со всеми полями строками"""
+    totals = {}
+    with gzip.open(f"{path}.gz", 'rt', encoding='utf-8') as f:
+        for line in f:
+            record = dict(zip(courier_bot.ORDER_FIELDS, line.rstrip('\n').split('|')))
+            record['packages'] = courier_bot.to_int(record['packages'])
+            record['price'] = courier_bot.to_int(record['price'])
+            add(totals, record)
+    return sum(bucket[0] for key, bucket in totals.items() if key[0] == 'restaurant')
+
+
+def archive_bytes(courier_bot, path: str) -> int:
+    courier_bot.conn.execute(
+        'INSERT INTO order_archive (day, part, path, archived_at) VALUES (?, ?, ?, ?)',
+        ('2024-01-01', 0, f"{path}.gz", '')
+    )
+    totals = {}
+    for record in courier_bot.order_store.read_archive(fields=courier_bot.ORDER_STATS_FIELDS):
+        add(totals, record)
+    return sum(bucket[0] for key, bucket in totals.items() if key[0] == 'restaurant')
+
+
+def import_legacy(courier_bot, path: str) -> int:
+    """Прежний import_orders_file: весь журнал собирается в dict записей"""
+    records = {}
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            parts = line.rstrip('\n').split('|')
+            if not parts[0]:
+                continue
+            while len(parts) < len(courier_bot.ORDER_FIELDS):
+                parts.append('None')
+            record = dict(zip(courier_bot.ORDER_FIELDS, parts))
+            if record['status'] == 'removed':
+                records.pop(record['id'], None)
+            else:
+                records[record['id']] = record
+    db = courier_bot.conn
+    db.executemany(
+        'INSERT OR IGNORE INTO orders VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+        [courier_bot.order_to_row(record) for record in records.values()]
+    )
+    db.commit()
+    return len(records)
+
+
+def import_mmap(courier_bot, path: str) -> int:
+    os.link(path, 'orders.txt')  # import_orders_file переименовывает файл после переноса
+    return courier_bot.import_orders_file(courier_bot.conn, 'orders.txt')
+
+
+CASES = {
+    'archive-legacy': archive_legacy,
+    'archive-bytes': archive_bytes,
+    'import-legacy': import_legacy,
+    'import-mmap': import_mmap,
+}
+
+
+def child(case: str, path: str, lines: int):
+    os.chdir(tempfile.mkdtemp(prefix='bench_order_scan_'))
+    import courier_bot
+    courier_bot.logging.disable(courier_bot.logging.WARNING)
+    baseline = rss_mb()
+    started = time.perf_counter()
+    result = CASES[case](courier_bot, path)
+    elapsed = time.perf_counter() - started
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(
+        f"{case:<15}{elapsed:>6.2f}s {lines / elapsed / 1e6:>5.2f}M lines/s  result={result:<9} "
+        f"peak RSS={peak:>5.0f} MB (+{peak - baseline:.0f} MB)"
+    )
+
+
+def main():
+    lines = int(sys.argv[1]) if len(sys.argv) > 1 else 2000000
+    path = os.path.join(tempfile.mkdtemp(prefix='bench_order_scan_'), 'orders.txt')
+    started = time.perf_counter()
+    generate(path, lines)
+    size = os.path.getsize(path) / 1024 / 1024
+    with open(path, 'rb') as src, gzip.open(f"{path}.gz", 'wb') as dst:
+        shutil.copyfileobj(src, dst)
+    print(
+        f"orders.txt: {lines} lines, {size:.0f} MB "
+        f"({os.path.getsize(f'{path}.gz') / 1024 / 1024:.0f} MB gzip), generated in {time.perf_counter() - started:.1f}s"
+    )
+    for case in CASES:
+        subprocess.run([sys.executable, __file__, '--child', case, path, str(lines)], check=True)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--child':
+        child(sys.argv[2], sys.argv[3], int(sys.argv[4]))
+    else:
+        main()
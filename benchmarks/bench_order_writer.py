@@ -0,0 +1,103 @@
+"""Изменения заказов: отдельная транзакция на каждое против OrderWriter с групповой фиксацией.
+
+Несколько параллельных «обработчиков» меняют статусы заказов. В режиме
+storage каждое изменение — свой вызов storage.run и свой COMMIT, в режиме
+writer изменения идут через order_writer и фиксируются пачками.
+Печатаются пропускная способность и время до подтверждения. Затем
+проверяется, что параллельные добавления к одному заказу не теряются и
+что ошибка одного изменения в пачке не откатывает остальные.
+
+    python benchmarks/bench_order_writer.py [обработчиков] [изменений на обработчик]
+"""
+import asyncio
+import os
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault('TELEGRAM_BOT_TOKEN', '123456:BENCHMARKBENCHMARKBENCHMARKBENCHMAR')
+os.chdir(tempfile.mkdtemp(prefix='bench_order_writer_'))
+
+import courier_bot  # noqa: E402
+
+STATUSES = ('accepted', 'delivered', 'declined', 'pending')
+
+
+def order(order_id: str) -> dict:
+    return {
+        'id': order_id, 'user_id': '1', 'restaurant': 'Ресторан', 'time': '30 мин', 'packages': '1',
+        'distances': 'Ближнее', 'price': '100', 'status': 'pending', 'date': '2024-01-01',
+        'created': '12:00:00', 'courier_id': 'None'
+    }
+
+
+async def via_storage(func, *args, **kwargs):
+    return await courier_bot.storage.run(func, *args, **kwargs)
+
+
+async def handler(submit, index: int, changes: int, latencies: list):
+    for i in range(changes):
+        started = time.perf_counter()
+        await submit(courier_bot.order_store.update, f"B{index}", status=STATUSES[i % len(STATUSES)])
+        latencies.append(time.perf_counter() - started)
+
+
+async def bench(name: str, submit, handlers: int, changes: int):
+    latencies = []
+    batches = courier_bot.order_writer.counters['batches']
+    started = time.perf_counter()
+    await asyncio.gather(*(handler(submit, i, changes, latencies) for i in range(handlers)))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    commits = courier_bot.order_writer.counters['batches'] - batches or len(latencies)
+    print(
+        f"{name:<8} {len(latencies) / elapsed:>7.0f} changes/s  commits={commits:<5} "
+        f"ack p50={statistics.median(latencies) * 1000:.1f}ms p99={latencies[int(len(latencies) * 0.99) - 1] * 1000:.1f}ms"
+    )
+
+
+async def check_concurrent_extend(count: int = 200):
+    writer = courier_bot.order_writer
+    store = courier_bot.order_store
+    await writer.submit(store.add, order('E1'))
+    await asyncio.gather(*(writer.submit(store.extend, 'E1', 1, ['Дальнее'], 10) for _ in range(count)))
+    record = store.get('E1')
+    row = courier_bot.conn.execute('SELECT packages, price FROM orders WHERE id=?', ('E1',)).fetchone()
+    assert record['packages'] == str(1 + count) and row == (1 + count, 100 + 10 * count), (record, row)
+    print(f"extend   {count} concurrent additions to one order, none lost")
+
+
+async def check_isolation():
+    writer = courier_bot.order_writer
+    store = courier_bot.order_store
+    results = await asyncio.gather(
+        writer.submit(store.add, order('I1')),
+        writer.submit(store.add, order('I1')),
+        writer.submit(store.add, order('I2')),
+        return_exceptions=True
+    )
+    assert isinstance(results[1], sqlite3.IntegrityError), results
+    stored = courier_bot.conn.execute("SELECT COUNT(*) FROM orders WHERE id IN ('I1', 'I2')").fetchone()[0]
+    assert stored == 2, stored
+    print(f"isolate  duplicate insert failed alone ({type(results[1]).__name__}), neighbours committed")
+
+
+async def main():
+    handlers = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    changes = int(sys.argv[2]) if len(sys.argv) > 2 else 40
+    courier_bot.logging.disable(courier_bot.logging.WARNING)
+    await asyncio.gather(*(courier_bot.order_writer.submit(courier_bot.order_store.add, order(f"B{i}"))
+                           for i in range(handlers)))
+    await bench('storage', via_storage, handlers, changes)
+    await bench('writer', courier_bot.order_writer.submit, handlers, changes)
+    await check_concurrent_extend()
+    await check_isolation()
+    print(f"writer   {courier_bot.order_writer.stats()}")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,115 @@
+"""Последний принятый заказ и отчёт заведения за день: SQL-запросы против RestaurantIndex.
+
+Горячая таблица заказов заполняется заказами за сегодня и вчера. Для
+каждого заведения сравниваются прежние запросы (по индексу user_id,
+order_date с фильтром по статусу) и ответы через RestaurantIndex, с
+проверкой совпадения результатов. «cold» — после сброса кэша заказов,
+когда запись последнего заказа читается из базы по id.
+
+    python benchmarks/bench_restaurant_index.py [заказов] [заведений]
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault('TELEGRAM_BOT_TOKEN', '123456:BENCHMARKBENCHMARKBENCHMARKBENCHMAR')
+os.chdir(tempfile.mkdtemp(prefix='bench_restaurant_index_'))
+
+import courier_bot  # noqa: E402
+
+
+def populate(count: int, restaurants: int):
+    now = datetime.now(courier_bot.TIME_ZONE)
+    days = [now.strftime('%Y-%m-%d'), (now - timedelta(days=1)).strftime('%Y-%m-%d')]
+    rows = []
+    for i in range(count):
+        rows.append((
+            f"Заказ #{i}", random.randint(1, restaurants), 'Ресторан', '30 мин',
+            random.randint(1, 5), 'Ближнее', random.randint(7, 40),
+            random.choice(['accepted', 'delivered', 'delivered', 'delivered', 'declined', 'pending']),
+            days[i * 2 // count], '12:00:00', random.randint(1, 50)
+        ))
+    db = courier_bot.conn
+    db.executemany('INSERT INTO orders VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+    db.commit()
+    courier_bot.order_store.index.rebuild(
+        courier_bot.order_from_row(row) for row in db.execute('SELECT * FROM orders ORDER BY rowid')
+    )
+    return days[1]
+
+
+def legacy_last_accepted(user_id: int):
+    row = courier_bot.conn.execute(
+        "SELECT * FROM orders WHERE user_id=? AND status='accepted' ORDER BY rowid DESC LIMIT 1",
+        (user_id,)
+    ).fetchone()
+    return courier_bot.order_from_row(row) if row else None
+
+
+def legacy_restaurant_totals(user_id: int, day: str):
+    return courier_bot.conn.execute(
+        '''SELECT status, SUM(packages), SUM(price)
+           FROM orders
+           WHERE user_id=? AND order_date=?
+           GROUP BY status''',
+        (user_id, day)
+    ).fetchall()
+
+
+def check_live(restaurants: int):
+    """Два новых заказа каждого заведения принимаются в обратном порядке создания"""
+    store = courier_bot.order_store
+    now = datetime.now(courier_bot.TIME_ZONE)
+    for user_id in range(1, restaurants + 1):
+        for n in (1, 2):
+            store.add({
+                'id': f"Живой #{user_id}-{n}", 'user_id': str(user_id), 'restaurant': 'Ресторан',
+                'time': '30 мин', 'packages': '1', 'distances': 'Ближнее', 'price': '7', 'status': 'pending',
+                'date': now.strftime('%Y-%m-%d'), 'created': now.strftime('%H:%M:%S'), 'courier_id': 'None'
+            })
+        store.claim(f"Живой #{user_id}-2", 1)
+        store.claim(f"Живой #{user_id}-1", 1)
+    for user_id in range(1, restaurants + 1):
+        assert legacy_last_accepted(user_id)['id'] == store.last_accepted(user_id)['id'] == f"Живой #{user_id}-2", user_id
+    print("results match after live claim()")
+
+
+def bench(name: str, func, restaurants: int, repeat: int = 5):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for user_id in range(1, restaurants + 1):
+            func(user_id)
+    elapsed = time.perf_counter() - started
+    print(f"{name:<22} {elapsed / (repeat * restaurants) * 1e6:>9.1f} us/call")
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    restaurants = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    today = populate(count, restaurants)
+    store = courier_bot.order_store
+    print(f"orders in hot table: {count}, restaurants: {restaurants}")
+
+    for user_id in range(1, restaurants + 1):
+        legacy = legacy_last_accepted(user_id)
+        indexed = store.last_accepted(user_id)
+        assert (legacy and legacy['id']) == (indexed and indexed['id']), user_id
+        assert legacy_restaurant_totals(user_id, today) == store.restaurant_totals(user_id, today), user_id
+    print("results match")
+
+    bench('last_accepted sql', legacy_last_accepted, restaurants)
+    bench('last_accepted index', store.last_accepted, restaurants)
+    store.evict()
+    bench('last_accepted cold', store.last_accepted, restaurants, repeat=1)
+    bench('day totals sql', lambda user_id: legacy_restaurant_totals(user_id, today), restaurants)
+    bench('day totals index', lambda user_id: store.restaurant_totals(user_id, today), restaurants)
+    check_live(restaurants)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+"""Память и задержка апдейта в режимах polling и webhook.
+
+Telegram подменён заглушкой Bot.__call__: getUpdates отдаёт апдейты из
+локальной очереди с семантикой long polling, ответы бота только
+засекаются. Задержка — от появления апдейта (в очереди getUpdates или
+POST на вебхук) до ответа обработчика /start. Память — RSS и PSS всех
+процессов бота, запущенных так же, как в __main__.
+
+    python benchmarks/bench_run_modes.py [апдейтов]
+"""
+import asyncio
+import logging
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault('TELEGRAM_BOT_TOKEN', '123456:BENCHMARKBENCHMARKBENCHMARKBENCHMAR')
+PORT = 18080
+
+
+def make_update(update_id: int) -> dict:
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': 1, 'type': 'private'},
+            'from': {'id': 1, 'is_bot': False, 'first_name': 'bench'},
+            'text': '/start'
+        }
+    }
+
+
+def install_stub(updates: asyncio.Queue = None, answered: list = None):
+    """Подменяет сетевые вызовы бота; getUpdates ждёт апдейт до таймаута"""
+    from aiogram import Bot, methods, types
+
+    async def call(self, method, request_timeout=None):
+        if isinstance(method, methods.GetMe):
+            return types.User(id=123456, is_bot=True, first_name='bench')
+        if isinstance(method, methods.GetUpdates):
+            if updates is None:
+                await asyncio.sleep(method.timeout or 0)
+                return []
+            try:
+                first = await asyncio.wait_for(updates.get(), method.timeout or 0)
+            except asyncio.TimeoutError:
+                return []
+            batch = [first]
+            while not updates.empty():
+                batch.append(updates.get_nowait())
+            return [types.Update(**update) for update in batch]
+        if isinstance(method, methods.SendMessage) and answered is not None:
+            answered.append(time.perf_counter())
+        return True
+
+    Bot.__call__ = call
+
+
+def serve(mode: str):
+    """Запуск бота так же, как в __main__, но с заглушкой вместо Telegram"""
+    if mode == 'webhook':
+        os.environ['WEBHOOK_URL'] = f'http://127.0.0.1:{PORT}'
+    install_stub()
+    import uvicorn
+    import courier_bot
+    uvicorn.run(courier_bot.app, host='127.0.0.1', port=PORT, log_level='warning')
+
+
+def process_tree(pid: int) -> list:
+    pids = [pid]
+    for task in os.listdir(f'/proc/{pid}/task'):
+        with open(f'/proc/{pid}/task/{task}/children') as f:
+            for child in f.read().split():
+                pids.extend(process_tree(int(child)))
+    return pids
+
+
+def memory_kb(pid: int) -> tuple:
+    rss = pss = 0
+    with open(f'/proc/{pid}/smaps_rollup') as f:
+        for line in f:
+            if line.startswith('Rss:'):
+                rss = int(line.split()[1])
+            elif line.startswith('Pss:'):
+                pss = int(line.split()[1])
+    return rss, pss
+
+
+def measure_memory(mode: str, warmup: float = 5.0):
+    process = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), '--serve', mode],
+        cwd=tempfile.mkdtemp(prefix=f'bench_{mode}_'),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL
+    )
+    try:
+        time.sleep(warmup)
+        pids = process_tree(process.pid)
+        usage = [memory_kb(pid) for pid in pids]
+    finally:
+        for pid in reversed(process_tree(process.pid)):
+            try:
+                os.kill(pid, 15)
+            except ProcessLookupError:
+                pass
+        process.wait()
+    rss = sum(item[0] for item in usage) / 1024
+    pss = sum(item[1] for item in usage) / 1024
+    print(f"{mode:<8} processes={len(pids)} rss={rss:.0f}MB pss={pss:.0f}MB")
+
+
+def report(mode: str, latencies: list):
+    latencies.sort()
+    print(
+        f"{mode:<8} updates={len(latencies)} "
+        f"latency median={statistics.median(latencies) * 1000:.1f}ms "
+        f"p95={latencies[int(len(latencies) * 0.95) - 1] * 1000:.1f}ms"
+    )
+
+
+async def latency_polling(count: int):
+    import courier_bot
+    updates = asyncio.Queue()
+    answered = []
+    install_stub(updates, answered)
+    polling = asyncio.create_task(courier_bot.dp.start_polling(courier_bot.bot, handle_signals=False))
+    await asyncio.sleep(0.5)
+    latencies = []
+    for i in range(count):
+        started = time.perf_counter()
+        updates.put_nowait(make_update(i))
+        while len(answered) <= i:
+            await asyncio.sleep(0.0005)
+        latencies.append(answered[i] - started)
+    await courier_bot.dp.stop_polling()
+    await polling
+    report('polling', latencies)
+
+
+async def latency_webhook(count: int):
+    import aiohttp
+    import uvicorn
+    import courier_bot
+    answered = []
+    install_stub(answered=answered)
+    courier_bot.WEBHOOK_URL = f'http://127.0.0.1:{PORT}'
+    server = uvicorn.Server(uvicorn.Config(courier_bot.app, host='127.0.0.1', port=PORT, log_level='warning'))
+    serving = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+    latencies = []
+    async with aiohttp.ClientSession() as session:
+        for i in range(count):
+            started = time.perf_counter()
+            async with session.post(f'http://127.0.0.1:{PORT}{courier_bot.WEBHOOK_PATH}', json=make_update(i)) as response:
+                response.raise_for_status()
+            while len(answered) <= i:
+                await asyncio.sleep(0.0005)
+            latencies.append(answered[i] - started)
+    server.should_exit = True
+    await serving
+    report('webhook', latencies)
+
+
+def main():
+    if len(sys.argv) > 2 and sys.argv[1] == '--serve':
+        serve(sys.argv[2])
+        return
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    measure_memory('polling')
+    measure_memory('webhook')
+    os.chdir(tempfile.mkdtemp(prefix='bench_run_modes_'))
+    logging.disable(logging.INFO)
+    asyncio.run(latency_polling(count))
+    asyncio.run(latency_webhook(count))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+"""Локальная заглушка Telegram Bot API на aiohttp.
+
+Реализует getMe, getUpdates (long polling), sendMessage, editMessageText,
+editMessageReplyMarkup, deleteMessage, answerCallbackQuery, а также
+setWebhook/deleteWebhook, чтобы бот запускался без правок. Задержка
+ответа, доля ошибок 5xx и доля ответов 429 с RetryAfter настраиваются.
+
+Бот направляется на заглушку переменной окружения:
+
+    python benchmarks/fake_bot_api.py --port 8081 --latency 0.1 --retry-after-rate 0.05
+    TELEGRAM_API_URL=http://127.0.0.1:8081 python courier_bot.py
+
+Служебные маршруты: POST /_updates кладёт апдейт в очередь getUpdates,
+GET /_stats отдаёт счётчики вызовов.
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+from collections import Counter
+
+from aiohttp import web
+
+
+class FakeBotAPI:
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0,
+                 retry_after_rate: float = 0.0, retry_after: int = 1, seed: int = None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.retry_after_rate = retry_after_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.updates = asyncio.Queue()
+        self.update_id = 0
+        self.message_id = 0
+        self.calls = Counter()
+        self.injected = Counter()
+        self.sent = []  # (время, chat_id, текст, reply_markup) для анализа сценариев
+        self.listeners = []
+        self.methods = {
+            'getme': self.get_me,
+            'getupdates': self.get_updates,
+            'sendmessage': self.send_message,
+            'editmessagetext': self.edit_message_text,
+            'editmessagereplymarkup': self.edit_message_reply_markup,
+            'deletemessage': self.delete_message,
+            'answercallbackquery': self.answer_callback_query,
+            'setwebhook': self.ok,
+            'deletewebhook': self.ok,
+        }
+        self.app = web.Application()
+        self.app.router.add_post('/bot{token}/{method}', self.handle)
+        self.app.router.add_post('/_updates', self.push_update_route)
+        self.app.router.add_get('/_stats', self.stats_route)
+
+    def push_update(self, update: dict):
+        self.update_id += 1
+        self.updates.put_nowait({**update, 'update_id': self.update_id})
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info['method'].lower()
+        self.calls[method] += 1
+        handler = self.methods.get(method)
+        if handler is None:
+            return self._error(404, f"Not Found: method {method} not implemented")
+        params = {key: self._decode(value) for key, value in (await request.post()).items()}
+        if method != 'getupdates':
+            delay = self.latency + self.random.uniform(0, self.jitter)
+            if delay:
+                await asyncio.sleep(delay)
+            roll = self.random.random()
+            if roll < self.retry_after_rate:
+                self.injected['retry_after'] += 1
+                return self._error(429, f"Too Many Requests: retry after {self.retry_after}",
+                                   {'retry_after': self.retry_after})
+            if roll < self.retry_after_rate + self.error_rate:
+                self.injected['error'] += 1
+                return self._error(500, "Internal Server Error")
+        return web.json_response({'ok': True, 'result': await handler(params)})
+
+    @staticmethod
+    def _decode(value: str):
+        try:
+            return json.loads(value)
+        except ValueError:
+            return value
+
+    @staticmethod
+    def _error(code: int, description: str, parameters: dict = None) -> web.Response:
+        body = {'ok': False, 'error_code': code, 'description': description}
+        if parameters:
+            body['parameters'] = parameters
+        return web.json_response(body, status=code)
+
+    def _message(self, chat_id, text: str = None, reply_markup=None) -> dict:
+        self.message_id += 1
+        message = {
+            'message_id': self.message_id,
+            'date': int(time.time()),
+            'chat': {'id': int(chat_id), 'type': 'private'},
+            'from': {'id': 123456, 'is_bot': True, 'first_name': 'fake'}
+        }
+        if text is not None:
+            message['text'] = text
+        if reply_markup and 'inline_keyboard' in reply_markup:
+            # В Message возвращается только inline-клавиатура
+            message['reply_markup'] = reply_markup
+        return message
+
+    async def get_me(self, params: dict) -> dict:
+        return {'id': 123456, 'is_bot': True, 'first_name': 'fake', 'username': 'fake_bot'}
+
+    async def get_updates(self, params: dict) -> list:
+        offset = int(params.get('offset') or 0)
+        timeout = float(params.get('timeout') or 0)
+        batch = []
+        try:
+            batch.append(await asyncio.wait_for(self.updates.get(), timeout) if timeout else self.updates.get_nowait())
+        except (asyncio.TimeoutError, asyncio.QueueEmpty):
+            return []
+        while not self.updates.empty():
+            batch.append(self.updates.get_nowait())
+        return [update for update in batch if update['update_id'] >= offset]
+
+    async def send_message(self, params: dict) -> dict:
+        message = self._message(params['chat_id'], str(params.get('text', '')), params.get('reply_markup'))
+        self.sent.append((time.perf_counter(), message['chat']['id'], message['text'], params.get('reply_markup')))
+        for listener in self.listeners:
+            listener(message)
+        return message
+
+    async def edit_message_text(self, params: dict) -> dict:
+        return self._message(params.get('chat_id', 0), str(params.get('text', '')), params.get('reply_markup'))
+
+    async def edit_message_reply_markup(self, params: dict) -> dict:
+        return self._message(params.get('chat_id', 0), reply_markup=params.get('reply_markup'))
+
+    async def delete_message(self, params: dict) -> bool:
+        return True
+
+    async def answer_callback_query(self, params: dict) -> bool:
+        return True
+
+    async def ok(self, params: dict) -> bool:
+        return True
+
+    async def push_update_route(self, request: web.Request) -> web.Response:
+        self.push_update(await request.json())
+        return web.json_response({'ok': True})
+
+    async def stats_route(self, request: web.Request) -> web.Response:
+        return web.json_response({'calls': dict(self.calls), 'injected': dict(self.injected)})
+
+    async def start(self, host: str = '127.0.0.1', port: int = 8081) -> web.AppRunner:
+        runner = web.AppRunner(self.app)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        return runner
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0.0, help='задержка ответа, с')
+    parser.add_argument('--jitter', type=float, default=0.0, help='случайная добавка к задержке, с')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='доля ответов 500')
+    parser.add_argument('--retry-after-rate', type=float, default=0.0, help='доля ответов 429')
+    parser.add_argument('--retry-after', type=int, default=1, help='retry_after в ответах 429, с')
+    args = parser.parse_args()
+    api = FakeBotAPI(args.latency, args.jitter, args.error_rate, args.retry_after_rate, args.retry_after)
+    web.run_app(api.app, host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,32 @@
 import asyncio
+import gzip
+import heapq
+import inspect
+import itertools
+import json
 import logging
+import mmap
 import sqlite3
+import threading
+import time
 import pytz
 import os
+from bisect import bisect_left
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 from datetime import datetime, timedelta
+from functools import partial
 from pathlib import Path
 from fastapi import FastAPI  # Перенесите этот импорт сюда!
-from aiogram import Bot, Dispatcher, types
-from aiogram.filters import Command, CommandStart
+from aiogram import BaseMiddleware, Bot, Dispatcher, types
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+from aiogram.filters import BaseFilter, Command, CommandStart
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
 from aiogram.types import (
     InlineKeyboardButton,
     InlineKeyboardMarkup,
@@ -27,9 +43,15 @@ load_dotenv()
 API_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 SECRET_PASSWORD = os.getenv('SECRET_PASSWORD')
 ADMIN_PASSWORD = os.getenv('ADMIN_PASSWORD')
-
-bot = Bot(token=API_TOKEN)
-dp = Dispatcher(storage=MemoryStorage())
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')  # если задан, бот работает через вебхук, иначе polling
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+WEBHOOK_PATH = '/webhook'
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')  # другой Bot API сервер, например benchmarks/fake_bot_api.py
+
+bot = Bot(
+    token=API_TOKEN,
+    session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None
+)
 
 logging.basicConfig(
     level=logging.INFO,
@@ -68,18 +90,250 @@ conn.execute('''CREATE TABLE IF NOT EXISTS blocked_couriers
              (user_id INTEGER PRIMARY KEY)''')
 conn.commit()
 
-pending_updates = {}
 
-def get_blocked_couriers():
-    try:
-        return [int(line) for line in file_operation('blocked_couriers.txt', 'r').splitlines() if line]
-    except:
-        return []
+ROLE_ADMIN = 'admin'
+ROLE_BLOCKED = 'blocked'
+ROLE_COURIER = 'courier'
+ROLE_RESTAURANT = 'restaurant'
+
+
+class Directory:
+    """Кэш справочников курьеров и заведений из SQLite.
 
-def add_blocked_courier(courier_id: int):
-    blocked = get_blocked_couriers()
-    if courier_id not in blocked:
-        file_operation('blocked_couriers.txt', 'a', courier_id)
+    Загружается целиком при первом обращении и сбрасывается методом
+    invalidate() из обработчиков, которые меняют таблицы. Счётчики
+    hits/misses показывают, сколько запросов обслужено из памяти.
+    Заодно это индекс ролей: role() по множествам отвечает, кто такой
+    пользователь, без чтения файлов.
+    """
+
+    def __init__(self, db: sqlite3.Connection):
+        self.db = db
+        self.couriers = None
+        self.restaurants = None
+        self.blocked = None
+        self.courier_ids = None
+        self.admin_id = None
+        self.hits = 0
+        self.misses = 0
+
+    def _ensure_loaded(self):
+        if self.couriers is not None:
+            self.hits += 1
+            return
+        self.misses += 1
+        self.couriers = {
+            user_id: name for user_id, name in self.db.execute('SELECT user_id, name FROM couriers')
+        }
+        self.restaurants = {
+            user_id: (name, tariff)
+            for user_id, name, tariff in self.db.execute('SELECT user_id, name, tariff FROM restaurants')
+        }
+        self.blocked = {user_id for (user_id,) in self.db.execute('SELECT user_id FROM blocked_couriers')}
+        # courier_id.txt ведётся вместе с таблицей, но в нём могут быть курьеры старых версий
+        self.courier_ids = set(self.couriers)
+        for line in file_operation('courier_id.txt', 'r').splitlines():
+            if line.strip().isdigit():
+                self.courier_ids.add(int(line))
+        admin_id = file_operation('admin_id.txt', 'r')
+        self.admin_id = int(admin_id) if admin_id.isdigit() else None
+
+    def invalidate(self):
+        self.couriers = None
+        self.restaurants = None
+        self.blocked = None
+        self.courier_ids = None
+        self.admin_id = None
+
+    def role(self, user_id: int):
+        """ROLE_* пользователя или None для незнакомого"""
+        self._ensure_loaded()
+        if user_id == self.admin_id:
+            return ROLE_ADMIN
+        if user_id in self.blocked:
+            return ROLE_BLOCKED
+        if user_id in self.courier_ids:
+            return ROLE_COURIER
+        if user_id in self.restaurants:
+            return ROLE_RESTAURANT
+        return None
+
+    def admin(self):
+        self._ensure_loaded()
+        return self.admin_id
+
+    def set_admin(self, user_id: int):
+        file_operation('admin_id.txt', 'w', user_id)
+        self.invalidate()
+
+    def block_courier(self, courier_id: int):
+        self.db.execute('INSERT OR IGNORE INTO blocked_couriers VALUES (?)', (courier_id,))
+        self.db.commit()
+        self.invalidate()
+
+    def courier_name(self, courier_id):
+        self._ensure_loaded()
+        try:
+            return self.couriers.get(int(courier_id))
+        except (TypeError, ValueError):
+            return None
+
+    def courier_names(self) -> dict:
+        self._ensure_loaded()
+        return self.couriers
+
+    def unblocked_couriers(self):
+        self._ensure_loaded()
+        return [(user_id, name) for user_id, name in self.couriers.items() if user_id not in self.blocked]
+
+    def restaurant_name(self, user_id: int):
+        self._ensure_loaded()
+        restaurant = self.restaurants.get(int(user_id))
+        return restaurant[0] if restaurant else None
+
+    def restaurant_tariff(self, user_id: int):
+        self._ensure_loaded()
+        restaurant = self.restaurants.get(int(user_id))
+        return restaurant[1] if restaurant else None
+
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+directory = Directory(conn)
+
+PENDING_ADDITION_TTL = 6 * 3600  # сколько ждать ответа курьера на добавление к заказу
+PENDING_ADDITIONS_MAX = 10000
+
+
+class PendingAdditions:
+    """Добавления к заказам, ждущие подтверждения курьера.
+
+    Каждое добавление — отдельная строка pending_additions со своим id,
+    поэтому несколько добавлений к одному заказу не затирают друг друга.
+    В памяти записи лежат в OrderedDict по id (он же порядок создания)
+    и в индексе order_id -> id: поиск за O(1), а просроченные и лишние
+    сверх capacity снимаются с начала. Таблица переживает перезапуск.
+    Методы блокирующие и вызываются через storage.run.
+    """
+
+    def __init__(self, db: sqlite3.Connection, ttl: float = PENDING_ADDITION_TTL,
+                 capacity: int = PENDING_ADDITIONS_MAX):
+        self.db = db
+        self.ttl = ttl
+        self.capacity = capacity
+        self.additions = OrderedDict()  # id -> запись
+        self.by_order = {}  # order_id -> {id: None} в порядке добавления
+        self.db.execute('''CREATE TABLE IF NOT EXISTS pending_additions
+                     (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                      order_id TEXT,
+                      user_id INTEGER,
+                      packages INTEGER,
+                      distances TEXT,
+                      price INTEGER,
+                      created REAL)''')
+        self.db.commit()
+        for row in self.db.execute('SELECT * FROM pending_additions ORDER BY id'):
+            self._index(self._from_row(row))
+
+    def __len__(self) -> int:
+        return len(self.additions)
+
+    @staticmethod
+    def _from_row(row) -> dict:
+        addition_id, order_id, user_id, packages, distances, price, created = row
+        return {
+            'id': addition_id,
+            'order_id': order_id,
+            'user_id': user_id,
+            'packages': packages,
+            'distances': distances.split(', '),
+            'price': price,
+            'created': created
+        }
+
+    def _index(self, addition: dict):
+        self.additions[addition['id']] = addition
+        self.by_order.setdefault(addition['order_id'], {})[addition['id']] = None
+
+    def _drop(self, addition_id: int) -> dict:
+        addition = self.additions.pop(addition_id)
+        ids = self.by_order[addition['order_id']]
+        del ids[addition_id]
+        if not ids:
+            del self.by_order[addition['order_id']]
+        return addition
+
+    def add(self, order_id: str, user_id: int, packages: int, distances: list, price: int) -> int:
+        created = time.time()
+        with self.db:
+            addition_id = self.db.execute(
+                'INSERT INTO pending_additions (order_id, user_id, packages, distances, price, created) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (order_id, user_id, packages, ', '.join(distances), price, created)
+            ).lastrowid
+        self._index(self._from_row((addition_id, order_id, user_id, packages, ', '.join(distances), price, created)))
+        while len(self.additions) > self.capacity:
+            oldest = next(iter(self.additions))
+            logger.warning(f"Pending addition {oldest} dropped: more than {self.capacity} waiting")
+            self.pop(oldest)
+        return addition_id
+
+    def pop(self, addition_id: int):
+        """Забирает добавление для обработки; None, если его уже нет или оно просрочено"""
+        addition = self.additions.get(addition_id)
+        if addition is None:
+            return None
+        with self.db:
+            self.db.execute('DELETE FROM pending_additions WHERE id=?', (addition_id,))
+        self._drop(addition_id)
+        if addition['created'] + self.ttl < time.time():
+            return None
+        return addition
+
+    def first_for_order(self, order_id: str):
+        """id самого старого добавления к заказу (для кнопок без id добавления)"""
+        ids = self.by_order.get(order_id)
+        return next(iter(ids)) if ids else None
+
+    def expire(self) -> list:
+        """Убирает добавления старше ttl и возвращает их"""
+        deadline = time.time() - self.ttl
+        expired = []
+        while self.additions:
+            addition = next(iter(self.additions.values()))
+            if addition['created'] >= deadline:
+                break
+            expired.append(self._drop(addition['id']))
+        if expired:
+            with self.db:
+                self.db.execute('DELETE FROM pending_additions WHERE created < ?', (deadline,))
+        return expired
+
+
+pending_additions = PendingAdditions(conn)
+
+def import_blocked_file(db: sqlite3.Connection, filename: str = 'blocked_couriers.txt') -> int:
+    """Переносит blocked_couriers.txt в таблицу blocked_couriers.
+
+    Раньше блокировки писались только в файл, а список курьеров читал
+    таблицу. Теперь таблица единственный источник, файл после переноса
+    переименовывается в *.imported.
+    """
+    if not os.path.exists(filename):
+        return 0
+    with open(filename, 'r', encoding='utf-8') as f:
+        ids = [(int(line),) for line in f if line.strip().isdigit()]
+    db.executemany('INSERT OR IGNORE INTO blocked_couriers VALUES (?)', ids)
+    db.commit()
+    os.replace(filename, f"{filename}.imported")
+    logger.info(f"Imported {len(ids)} blocked couriers from {filename}")
+    return len(ids)
+
+try:
+    import_blocked_file(conn)
+except Exception as e:
+    logger.error(f"Blocked couriers import error: {e}")
 
 def file_operation(filename: str, mode: str, data=None):
     try:
@@ -98,163 +352,1645 @@ def file_operation(filename: str, mode: str, data=None):
         logger.error(f"File error ({filename}): {e}")
         return ''
 
-def get_couriers():
-    try:
-        return [int(line) for line in file_operation('courier_id.txt', 'r').splitlines() if line]
-    except:
-        return []
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram:
+    """Гистограмма в формате Prometheus с одной меткой"""
+
+    def __init__(self, name: str, help_text: str, label: str, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.buckets = buckets
+        self.series = {}  # значение метки -> [счётчики корзин..., сумма, количество]
+
+    def observe(self, value: float, label_value: str):
+        series = self.series.get(label_value)
+        if series is None:
+            series = self.series[label_value] = [0] * len(self.buckets) + [0.0, 0]
+        index = bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            series[index] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for label_value, series in sorted(self.series.items()):
+            labels = f'{self.label}="{label_value}"'
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{labels},le="+Inf"}} {series[-1]}')
+            lines.append(f'{self.name}_sum{{{labels}}} {series[-2]:.6f}')
+            lines.append(f'{self.name}_count{{{labels}}} {series[-1]}')
+        return lines
+
+
+class Counter:
+    """Счётчик в формате Prometheus с одной меткой"""
+
+    def __init__(self, name: str, help_text: str, label: str):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.values = {}
+
+    def inc(self, label_value: str, amount: int = 1):
+        self.values[label_value] = self.values.get(label_value, 0) + amount
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for label_value, value in sorted(self.values.items()):
+            lines.append(f'{self.name}{{{self.label}="{label_value}"}} {value}')
+        return lines
+
+
+handler_latency = Histogram('bot_handler_seconds', 'Handler execution time', 'handler')
+handler_errors = Counter('bot_handler_errors_total', 'Handler exceptions', 'handler')
+storage_latency = Histogram('bot_storage_seconds', 'Storage call time including queue wait', 'op')
+send_latency = Histogram('bot_outbound_send_seconds', 'sendMessage call time', 'lane')
+send_errors = Counter('bot_outbound_send_errors_total', 'sendMessage errors', 'error')
+ACCEPT_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1800)
+accept_latency = Histogram(
+    'bot_order_accept_seconds', 'Time from first offer to accept', 'mode', ACCEPT_BUCKETS
+)
+HOP_BUCKETS = (0, 1, 2, 3, 4, 5, 8)
+redirect_hops = Histogram(
+    'bot_order_redirect_hops', 'Redirects before an order was accepted or given up', 'outcome', HOP_BUCKETS
+)
+
+
+class Storage:
+    """Отдельный поток для блокирующего ввода-вывода (файлы и SQLite).
+
+    Все операции с диском выполняются по очереди в одном рабочем потоке,
+    поэтому соединение SQLite не используется параллельно, а обработчики
+    aiogram только ждут результат и не останавливают цикл событий.
+    """
+
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='storage')
+
+    async def run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        try:
+            return await loop.run_in_executor(self.executor, partial(func, *args, **kwargs))
+        finally:
+            storage_latency.observe(time.perf_counter() - started, getattr(func, '__qualname__', 'other'))
+
+    def queue_depth(self) -> int:
+        return self.executor._work_queue.qsize()
+
+
+storage = Storage()
+
+async def read_admin_id():
+    return await storage.run(directory.admin)
+
+async def user_role(user_id: int):
+    return await storage.run(directory.role, user_id)
+
+async def is_admin(user_id: int) -> bool:
+    return await user_role(user_id) == ROLE_ADMIN
+
+
+FSM_CACHE_SIZE = 10000  # состояний пользователей в памяти
+FSM_TTL = 24 * 3600  # брошенный диалог забывается через сутки
+FSM_FLUSH_INTERVAL = 1.0  # секунд между пакетными записями в базу
+
+
+class SQLiteFSMStorage(BaseStorage):
+    """FSM-хранилище aiogram в таблице fsm_states с LRU-кэшем в памяти.
+
+    Состояние и данные (JSON-строкой) держатся в OrderedDict, изменения
+    копятся в dirty и раз в FSM_FLUSH_INTERVAL пишутся одной транзакцией
+    через поток storage, так что шаг мастера заказа не ждёт диска. При
+    переполнении вытесняются давно не тронутые записи: несохранённые
+    остаются в dirty до записи. Состояния старше FSM_TTL сбрасываются при
+    чтении и удаляются sweep(). После перезапуска мастер продолжается с
+    того же шага.
+    """
+
+    def __init__(self, db: sqlite3.Connection, capacity: int = FSM_CACHE_SIZE, ttl: float = FSM_TTL,
+                 flush_interval: float = FSM_FLUSH_INTERVAL):
+        self.db = db
+        self.capacity = capacity
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.cache = OrderedDict()  # StorageKey -> [состояние, данные JSON, время изменения]
+        self.dirty = {}  # StorageKey -> та же запись, ещё не записанная в базу
+        self.data_bytes = 0
+        self.flush_task = None
+        self.counters = {'hits': 0, 'loads': 0, 'evicted': 0, 'expired': 0, 'flushes': 0, 'written': 0}
+        self.db.execute('''CREATE TABLE IF NOT EXISTS fsm_states
+                     (bot_id INTEGER,
+                      chat_id INTEGER,
+                      user_id INTEGER,
+                      destiny TEXT,
+                      state TEXT,
+                      data TEXT,
+                      updated REAL,
+                      PRIMARY KEY (bot_id, chat_id, user_id, destiny))''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS idx_fsm_updated ON fsm_states (updated)')
+        self.db.commit()
+
+    @staticmethod
+    def _row_key(key: StorageKey) -> tuple:
+        return key.bot_id, key.chat_id, key.user_id, key.destiny
+
+    def _load(self, key: StorageKey) -> list:
+        row = self.db.execute(
+            'SELECT state, data, updated FROM fsm_states WHERE bot_id=? AND chat_id=? AND user_id=? AND destiny=?',
+            self._row_key(key)
+        ).fetchone()
+        return list(row) if row else [None, '{}', time.time()]
+
+    def _write(self, upserts: list, deletes: list):
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO fsm_states VALUES (?, ?, ?, ?, ?, ?, ?)', upserts)
+            self.db.executemany(
+                'DELETE FROM fsm_states WHERE bot_id=? AND chat_id=? AND user_id=? AND destiny=?', deletes
+            )
+
+    def _put(self, key: StorageKey, record: list):
+        self.cache[key] = record
+        self.data_bytes += len(record[1])
+        while len(self.cache) > self.capacity:
+            _, evicted = self.cache.popitem(last=False)
+            self.data_bytes -= len(evicted[1])
+            self.counters['evicted'] += 1
+
+    async def _record(self, key: StorageKey) -> list:
+        record = self.cache.get(key)
+        if record is not None:
+            self.counters['hits'] += 1
+            self.cache.move_to_end(key)
+        else:
+            record = self.dirty.get(key)
+            if record is None:
+                self.counters['loads'] += 1
+                record = await storage.run(self._load, key)
+            # Пока шла загрузка, запись мог положить в кэш другой апдейт
+            if key in self.cache:
+                return await self._record(key)
+            self._put(key, record)
+        if (record[0] is not None or record[1] != '{}') and record[2] + self.ttl < time.time():
+            self.counters['expired'] += 1
+            self._set(key, record, None, '{}')
+        return record
+
+    def _set(self, key: StorageKey, record: list, state, data: str):
+        if key in self.cache:
+            self.data_bytes += len(data) - len(record[1])
+        record[0], record[1], record[2] = state, data, time.time()
+        self.dirty[key] = record
+        if self.flush_task is None or self.flush_task.done():
+            self.flush_task = asyncio.get_running_loop().create_task(self._flush_later())
+
+    async def _flush_later(self):
+        while self.dirty:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self):
+        """Пишет накопленные изменения в fsm_states одной транзакцией"""
+        if not self.dirty:
+            return
+        batch, self.dirty = self.dirty, {}
+        upserts = []
+        deletes = []
+        for key, (state, data, updated) in batch.items():
+            if state is None and data == '{}':
+                deletes.append(self._row_key(key))
+            else:
+                upserts.append(self._row_key(key) + (state, data, updated))
+        try:
+            await storage.run(self._write, upserts, deletes)
+        except Exception as e:
+            logger.error(f"FSM flush error: {e}")
+            for key, record in batch.items():
+                self.dirty.setdefault(key, record)
+            return
+        self.counters['flushes'] += 1
+        self.counters['written'] += len(batch)
+
+    async def sweep(self) -> int:
+        """Удаляет состояния, не менявшиеся дольше ttl, из памяти и из базы"""
+        deadline = time.time() - self.ttl
+        for key in [key for key, record in self.cache.items() if record[2] < deadline and key not in self.dirty]:
+            self.data_bytes -= len(self.cache.pop(key)[1])
+        removed = await storage.run(self._sweep, deadline)
+        self.counters['expired'] += removed
+        return removed
+
+    def _sweep(self, deadline: float) -> int:
+        with self.db:
+            return self.db.execute('DELETE FROM fsm_states WHERE updated < ?', (deadline,)).rowcount
+
+    def stats(self) -> dict:
+        return {
+            'cached': len(self.cache),
+            'capacity': self.capacity,
+            'dirty': len(self.dirty),
+            'data_bytes': self.data_bytes,
+            **self.counters
+        }
+
+    async def set_state(self, bot: Bot, key: StorageKey, state: StateType = None) -> None:
+        record = await self._record(key)
+        self._set(key, record, state.state if isinstance(state, State) else state, record[1])
+
+    async def get_state(self, bot: Bot, key: StorageKey):
+        return (await self._record(key))[0]
+
+    async def set_data(self, bot: Bot, key: StorageKey, data: dict) -> None:
+        record = await self._record(key)
+        self._set(key, record, record[0], json.dumps(data, ensure_ascii=False))
+
+    async def get_data(self, bot: Bot, key: StorageKey) -> dict:
+        return json.loads((await self._record(key))[1])
+
+    async def close(self) -> None:
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+        await self.flush()
+
+
+dp = Dispatcher(storage=SQLiteFSMStorage(conn))
+
+
+PRIORITY_OFFER = 0   # предложения заказов курьерам
+PRIORITY_NOTIFY = 1  # уведомления заведениям и администратору
+PRIORITY_BULK = 2    # рассылки отчётов
+LANE_NAMES = {PRIORITY_OFFER: 'offer', PRIORITY_NOTIFY: 'notify', PRIORITY_BULK: 'bulk'}
+
+GLOBAL_SEND_RATE = 25  # сообщений в секунду, с запасом до лимита Telegram в 30/с
+CHAT_SEND_RATE = 1     # сообщений в секунду в один чат
+CHAT_SEND_BURST = 3
+SEND_WORKERS = 8
+SEND_MAX_ATTEMPTS = 4
+SEND_BACKOFF = 0.5
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self) -> float:
+        """Сколько ждать до появления токена (0, если он уже есть)"""
+        self._refill(time.monotonic())
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self._refill(time.monotonic())
+        self.tokens -= 1
+
+    def is_full(self) -> bool:
+        self._refill(time.monotonic())
+        return self.tokens >= self.capacity
+
+
+class OutboundSender:
+    """Единая очередь исходящих сообщений в Telegram.
+
+    Сообщения разбираются по приоритетам (предложения курьерам раньше
+    рассылок), ограничиваются общим и поканальным token bucket, при
+    RetryAfter и сетевых ошибках повторяются с задержкой. send() ждёт
+    фактической отправки и пробрасывает окончательную ошибку вызывающему.
+    """
+
+    def __init__(self):
+        self.loop = None
+        self.queue = None
+        self.workers = []
+        self.seq = 0
+        self.global_bucket = TokenBucket(GLOBAL_SEND_RATE, GLOBAL_SEND_RATE)
+        self.chat_buckets = {}
+        self.depth = {PRIORITY_OFFER: 0, PRIORITY_NOTIFY: 0, PRIORITY_BULK: 0}
+        self.counters = {'sent': 0, 'failed': 0, 'retried': 0}
+
+    def _ensure_started(self):
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            # Очередь привязана к циклу событий: в новом цикле (повторный asyncio.run) начинаем с новой
+            self.loop = loop
+            self.queue = asyncio.PriorityQueue()
+            self.workers = []
+            self.depth = dict.fromkeys(self.depth, 0)
+        self.workers = [task for task in self.workers if not task.done()]
+        while len(self.workers) < SEND_WORKERS:
+            self.workers.append(loop.create_task(self._worker()))
+
+    def _put(self, job: dict):
+        self.seq += 1
+        self.depth[job['priority']] += 1
+        self.queue.put_nowait((job['priority'], self.seq, job))
+
+    async def send(self, chat_id, text: str, priority: int = PRIORITY_NOTIFY, **kwargs):
+        self._ensure_started()
+        future = asyncio.get_running_loop().create_future()
+        self._put({
+            'chat_id': chat_id,
+            'text': text,
+            'kwargs': kwargs,
+            'priority': priority,
+            'attempt': 0,
+            'future': future
+        })
+        return await future
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) > 10000:
+                self.chat_buckets = {key: value for key, value in self.chat_buckets.items() if not value.is_full()}
+            bucket = self.chat_buckets[chat_id] = TokenBucket(CHAT_SEND_RATE, CHAT_SEND_BURST)
+        return bucket
+
+    def _retry_later(self, job: dict, delay: float):
+        job['attempt'] += 1
+        self.counters['retried'] += 1
+        asyncio.get_running_loop().call_later(delay, self._put, job)
+
+    async def _worker(self):
+        while True:
+            _, _, job = await self.queue.get()
+            self.depth[job['priority']] -= 1
+            chat_bucket = self._chat_bucket(job['chat_id'])
+            while (delay := max(self.global_bucket.delay(), chat_bucket.delay())) > 0:
+                await asyncio.sleep(delay)
+            self.global_bucket.take()
+            chat_bucket.take()
+            started = time.perf_counter()
+            try:
+                result = await bot.send_message(job['chat_id'], job['text'], **job['kwargs'])
+            except Exception as e:
+                error = e
+            else:
+                error = None
+            send_latency.observe(time.perf_counter() - started, LANE_NAMES[job['priority']])
+            if error is None:
+                self.counters['sent'] += 1
+                if not job['future'].done():
+                    job['future'].set_result(result)
+                continue
+            send_errors.inc(type(error).__name__)
+            if job['attempt'] + 1 < SEND_MAX_ATTEMPTS:
+                if isinstance(error, TelegramRetryAfter):
+                    self._retry_later(job, error.retry_after)
+                    continue
+                if isinstance(error, (TelegramNetworkError, TelegramServerError)):
+                    self._retry_later(job, SEND_BACKOFF * 2 ** job['attempt'])
+                    continue
+            self.counters['failed'] += 1
+            if not job['future'].done():
+                job['future'].set_exception(error)
+
+    def stats(self) -> dict:
+        return {
+            'queued': dict(self.depth),
+            'chats': len(self.chat_buckets),
+            **self.counters
+        }
+
+
+outbound = OutboundSender()
+
+ACCEPT_TIMEOUT = 300  # секунд на то, чтобы курьер принял или отклонил заказ
+
+
+class TimerScheduler:
+    """Отложенные вызовы на одной задаче и min-heap сроков.
+
+    schedule() стоит O(log n), cancel() помечает запись за O(1), а
+    помеченные записи выбрасываются, когда доходят до вершины кучи (или
+    при уплотнении, если их стало больше половины). Задача спит до
+    ближайшего срока и просыпается раньше, если появился более ранний.
+    На один ключ приходится один таймер: повторный schedule() заменяет его.
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.entries = {}
+        self.seq = 0
+        self.cancelled = 0
+        self.fired = 0
+        self.task = None
+        self.wakeup = None
+        self.running = set()  # сработавшие колбэки: ссылки держим, пока задачи не завершатся
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def _ensure_started(self):
+        if self.task is None or self.task.done():
+            self.wakeup = asyncio.Event()
+            self.task = asyncio.get_running_loop().create_task(self._run())
+
+    def schedule(self, key, delay: float, callback, *args):
+        self.cancel(key)
+        self._ensure_started()
+        self.seq += 1
+        entry = [time.monotonic() + delay, self.seq, key, callback, args]
+        self.entries[key] = entry
+        heapq.heappush(self.heap, entry)
+        if self.heap[0] is entry:
+            self.wakeup.set()
+
+    def cancel(self, key) -> bool:
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return False
+        entry[3] = None
+        self.cancelled += 1
+        if self.cancelled > 1000 and self.cancelled * 2 > len(self.heap):
+            self.heap = [item for item in self.heap if item[3] is not None]
+            heapq.heapify(self.heap)
+            self.cancelled = 0
+        return True
+
+    async def _run(self):
+        while True:
+            while self.heap and self.heap[0][3] is None:
+                heapq.heappop(self.heap)
+                self.cancelled -= 1
+            if self.heap and self.heap[0][0] <= time.monotonic():
+                _, _, key, callback, args = heapq.heappop(self.heap)
+                del self.entries[key]
+                self.fired += 1
+                task = asyncio.create_task(self._fire(key, callback, args))
+                self.running.add(task)
+                task.add_done_callback(self.running.discard)
+                continue
+            self.wakeup.clear()
+            timeout = self.heap[0][0] - time.monotonic() if self.heap else None
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _fire(self, key, callback, args):
+        try:
+            await callback(*args)
+        except Exception as e:
+            logger.error(f"Timer {key} failed: {e}")
+
+    def stats(self) -> dict:
+        return {'pending': len(self.entries), 'heap': len(self.heap), 'fired': self.fired, 'running': len(self.running)}
+
+
+acceptance_timers = TimerScheduler()
+
+OFFER_FANOUT = max(1, int(os.getenv('OFFER_FANOUT', '1')))  # скольким курьерам сразу предлагать заказ
+REDIRECT_MAX_HOPS = 5  # сколько раз заказ перенаправляется, прежде чем уйти админу
+REDIRECT_BACKOFF = 1.0  # пауза перед вторым перенаправлением, дальше удваивается
+REDIRECT_BACKOFF_MAX = 30.0
+
+
+def redirect_delay(hop: int) -> float:
+    """Пауза перед перенаправлением номер hop: первое сразу, дальше 1, 2, 4... секунд"""
+    if hop <= 1:
+        return 0.0
+    return min(REDIRECT_BACKOFF_MAX, REDIRECT_BACKOFF * 2 ** (hop - 2))
+
+
+class OfferBoard:
+    """Открытые предложения заказов курьерам.
+
+    Для каждого заказа хранится, каким курьерам и каким сообщением он
+    предложен, каких курьеров уже пробовали (предлагали, получили отказ
+    или не смогли доставить сообщение), сколько было перенаправлений и
+    когда ушло первое предложение. Когда заказ принят, по этому списку
+    снимаются сообщения остальных курьеров.
+    """
+
+    def __init__(self):
+        self.offers = {}  # order_id -> {courier_id: message_id}
+        self.tried = {}  # order_id -> курьеры, которым заказ больше не предлагается
+        self.hops = {}  # order_id -> число перенаправлений
+        self.offered_at = {}  # order_id -> время первого предложения
+
+    def __len__(self) -> int:
+        return len(self.offers)
+
+    def add(self, order_id: str, courier_id: int, message_id: int):
+        self.offers.setdefault(order_id, {})[courier_id] = message_id
+        self.offered_at.setdefault(order_id, time.monotonic())
+
+    def couriers(self, order_id: str) -> set:
+        return set(self.offers.get(order_id, ()))
+
+    def mark_tried(self, order_id: str, couriers):
+        self.tried.setdefault(order_id, set()).update(couriers)
+
+    def tried_couriers(self, order_id: str) -> set:
+        return set(self.tried.get(order_id, ()))
+
+    def next_hop(self, order_id: str) -> int:
+        hop = self.hops[order_id] = self.hops.get(order_id, 0) + 1
+        return hop
+
+    def remove(self, order_id: str, courier_id: int):
+        offers = self.offers.get(order_id)
+        if offers is not None:
+            offers.pop(courier_id, None)
+            if not offers:
+                del self.offers[order_id]
+
+    def withdraw(self, order_id: str) -> dict:
+        """Снимает все открытые предложения заказа, не закрывая его"""
+        return self.offers.pop(order_id, {})
+
+    def close(self, order_id: str):
+        """Заказ принят, удалён или никем не взят.
+
+        Возвращает (открытые предложения, секунд с первого предложения,
+        число перенаправлений).
+        """
+        self.tried.pop(order_id, None)
+        offered_at = self.offered_at.pop(order_id, None)
+        waited = time.monotonic() - offered_at if offered_at is not None else None
+        return self.offers.pop(order_id, {}), waited, self.hops.pop(order_id, 0)
+
+
+offer_board = OfferBoard()
+
+class CourierRegistry:
+    """Курьеры на смене в памяти с круговой раздачей заказов.
+
+    OrderedDict работает как кольцо: следующий курьер берётся из начала
+    и переставляется в конец, поэтому раздача, проверка и снятие со
+    смены стоят O(1). Состав смены сохраняется в active_couriers.txt
+    фоновой задачей и восстанавливается при старте.
+    """
+
+    def __init__(self, filename: str = ACTIVE_COURIERS_FILE):
+        self.filename = filename
+        self.couriers = OrderedDict()
+        self.dirty = False
+        self.save_task = None
+        try:
+            for line in file_operation(self.filename, 'r').splitlines():
+                if line:
+                    self.couriers[int(line)] = None
+        except ValueError as e:
+            logger.error(f"Active couriers load error: {e}")
+
+    def __contains__(self, courier_id) -> bool:
+        return courier_id in self.couriers
+
+    def __len__(self) -> int:
+        return len(self.couriers)
+
+    def list(self):
+        return list(self.couriers)
+
+    def add(self, courier_id: int):
+        if courier_id not in self.couriers:
+            self.couriers[courier_id] = None
+            self.schedule_save()
+
+    def remove(self, courier_id: int):
+        if courier_id in self.couriers:
+            del self.couriers[courier_id]
+            self.schedule_save()
+
+    def next(self):
+        if not self.couriers:
+            return None
+        courier_id, _ = self.couriers.popitem(last=False)
+        self.couriers[courier_id] = None
+        return courier_id
+
+    def touch(self, courier_id: int):
+        """Переставляет курьера в конец кольца, как будто он только что получил заказ"""
+        if courier_id in self.couriers:
+            self.couriers.move_to_end(courier_id)
+
+    def schedule_save(self):
+        self.dirty = True
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.dirty = False
+            file_operation(self.filename, 'w', '\n'.join(map(str, self.couriers)))
+            return
+        if self.save_task is None or self.save_task.done():
+            self.save_task = loop.create_task(self._save())
+
+    async def _save(self):
+        loop = asyncio.get_running_loop()
+        while self.dirty:
+            self.dirty = False
+            data = '\n'.join(map(str, self.couriers))
+            await loop.run_in_executor(storage.executor, file_operation, self.filename, 'w', data)
+
+
+courier_registry = CourierRegistry()
 
 def get_active_couriers():
-    try:
-        return [int(line) for line in file_operation(ACTIVE_COURIERS_FILE, 'r').splitlines() if line]
-    except:
-        return []
+    return courier_registry.list()
 
 def add_active_courier(courier_id: int):
-    active = get_active_couriers()
-    if courier_id not in active:
-        active.append(courier_id)
-        file_operation(ACTIVE_COURIERS_FILE, 'w', '\n'.join(map(str, active)))
-        file_operation('courier_index.txt', 'w', 0)
+    courier_registry.add(courier_id)
 
 def remove_active_courier(courier_id: int):
-    active = get_active_couriers()
-    if courier_id in active:
-        active.remove(courier_id)
-        file_operation(ACTIVE_COURIERS_FILE, 'w', '\n'.join(map(str, active)))
-        file_operation('courier_index.txt', 'w', 0)
-
-def next_courier():
-    couriers = get_active_couriers()
-    if not couriers:
+    courier_registry.remove(courier_id)
+
+class CourierLoad:
+    """Незакрытые посылки каждого курьера: предложенные и принятые.
+
+    Заказ числится за тем курьером, которому его последним предложили
+    или который его принял; assign() переносит его, release() снимает
+    после доставки, отказа или отмены. Счётчики живут в памяти и при
+    старте восстанавливаются из принятых заказов.
+    """
+
+    def __init__(self):
+        self.packages = {}  # courier_id -> посылки
+        self.orders = {}  # order_id -> (courier_id, посылки)
+
+    def get(self, courier_id: int) -> int:
+        return self.packages.get(courier_id, 0)
+
+    def assign(self, order_id: str, courier_id: int, packages: int):
+        self.release(order_id)
+        self.orders[order_id] = (courier_id, packages)
+        self.packages[courier_id] = self.packages.get(courier_id, 0) + packages
+
+    def release(self, order_id: str):
+        entry = self.orders.pop(order_id, None)
+        if entry is None:
+            return
+        courier_id, packages = entry
+        left = self.packages.get(courier_id, 0) - packages
+        if left > 0:
+            self.packages[courier_id] = left
+        else:
+            self.packages.pop(courier_id, None)
+
+    def seed(self, records):
+        self.packages = {}
+        self.orders = {}
+        for record in records:
+            self.assign(record['id'], to_int(record['courier_id']), to_int(record['packages']))
+
+
+class RoundRobinStrategy:
+    """Курьеры по кругу, без учёта загрузки"""
+
+    def pick(self, registry: CourierRegistry, load: CourierLoad, exclude=()):
+        for _ in range(len(registry)):
+            courier_id = registry.next()
+            if courier_id not in exclude:
+                return courier_id
         return None
-    try:
-        idx = int(file_operation('courier_index.txt', 'r') or 0)
-        idx = idx % len(couriers)
-    except ValueError:
-        idx = 0
-    current = couriers[idx]
-    new_idx = (idx + 1) % len(couriers)
-    file_operation('courier_index.txt', 'w', new_idx)
-    return current
+
+
+class LeastLoadedStrategy:
+    """Курьер с наименьшим числом незакрытых посылок.
+
+    При равенстве выигрывает тот, кто дольше не получал заказ: выбранный
+    уходит в конец кольца CourierRegistry.
+    """
+
+    def pick(self, registry: CourierRegistry, load: CourierLoad, exclude=()):
+        best = None
+        best_load = None
+        for courier_id in registry.couriers:
+            if courier_id in exclude:
+                continue
+            courier_load = load.get(courier_id)
+            if best is None or courier_load < best_load:
+                best, best_load = courier_id, courier_load
+                if not courier_load:
+                    break
+        if best is not None:
+            registry.touch(best)
+        return best
+
+
+DISPATCH_STRATEGIES = {
+    'round_robin': RoundRobinStrategy(),
+    'least_loaded': LeastLoadedStrategy(),
+}
+courier_load = CourierLoad()
+dispatch_strategy = DISPATCH_STRATEGIES[os.getenv('DISPATCH_STRATEGY', 'least_loaded')]
+
+def next_courier(exclude=()):
+    """Следующий курьер для заказа, кроме курьеров из exclude"""
+    return dispatch_strategy.pick(courier_registry, courier_load, exclude)
+
+ORDER_ID_BLOCK = 100
+
+
+class OrderIdAllocator:
+    """Счётчик заказов в памяти с резервированием номеров блоками.
+
+    В order_counter.txt хранится верхняя граница уже зарезервированного
+    блока, а не последний выданный номер. Граница записывается на диск
+    (с fsync) до выдачи первого номера из блока, поэтому после сбоя
+    счёт продолжается с неё: номера могут пропускаться, но не повторяются.
+    """
+
+    def __init__(self, filename: str = 'order_counter.txt', block: int = ORDER_ID_BLOCK):
+        self.filename = filename
+        self.block = block
+        self.lock = threading.Lock()
+        try:
+            self.counter = int(file_operation(self.filename, 'r') or 0)
+        except ValueError:
+            self.counter = 0
+        self.reserved = self.counter
+
+    def _reserve(self, limit: int):
+        tmp_name = f"{self.filename}.tmp"
+        with open(tmp_name, 'w', encoding='utf-8') as f:
+            f.write(str(limit))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_name, self.filename)
+        self.reserved = limit
+
+    def next(self) -> int:
+        with self.lock:
+            if self.counter >= self.reserved:
+                self._reserve(self.counter + self.block)
+            self.counter += 1
+            return self.counter
+
+
+order_ids = OrderIdAllocator()
 
 def order_id_generator():
-    try:
-        counter = int(file_operation('order_counter.txt', 'r') or 0)
-    except ValueError:
-        counter = 0
-    counter += 1
-    file_operation('order_counter.txt', 'w', counter)
-    return f"Заказ #{counter}"
+    return f"Заказ #{order_ids.next()}"
+
+ORDER_ARCHIVE_DIR = 'orders_archive'
+ORDER_HOT_DAYS = 1  # сколько прошлых дней кроме сегодняшнего держать в таблице orders
+ORDER_CLOSED_STATUSES = ('delivered', 'declined')  # только такие заказы уходят в архив
+ORDERS_FILE = 'orders.txt'
+ORDER_FIELDS = (
+    'id', 'user_id', 'restaurant', 'time', 'packages', 'distances',
+    'price', 'status', 'date', 'created', 'courier_id'
+)
+
+
+def to_int(value) -> int:
+    value = str(value)
+    return int(value) if value.isdigit() else 0
+
+
+class OrderStats:
+    """Накопительные агрегаты заказов: день × заведение × курьер × статус.
+
+    Корзины сгруппированы по дням, каждая хранит [заказы, посылки, сумма],
+    поэтому отчёт за период трогает только свои дни. Агрегаты меняются
+    вместе с заказами в OrderStore и сохраняются в таблицу order_stats,
+    так что после перезапуска пересчитывать историю не нужно. Итоги
+    за всю историю по заведениям и курьерам ведутся отдельно, чтобы
+    полный отчёт не обходил все корзины.
+    """
+
+    def __init__(self, db: sqlite3.Connection):
+        self.db = db
+        self.days = {}
+        self.restaurants = {}  # заведение -> [заказы, посылки, сумма] за всю историю
+        self.couriers = {}  # courier_id -> [заказы, посылки, сумма] за всю историю
+        self.db.execute('''CREATE TABLE IF NOT EXISTS order_stats
+                     (day TEXT,
+                      user_id TEXT,
+                      restaurant TEXT,
+                      courier_id TEXT,
+                      status TEXT,
+                      orders INTEGER,
+                      packages INTEGER,
+                      price INTEGER,
+                      PRIMARY KEY (day, user_id, restaurant, courier_id, status))''')
+        self.db.commit()
+        for row in self.db.execute('SELECT * FROM order_stats'):
+            self.days.setdefault(row[0], {})[tuple(row[:5])] = list(row[5:])
+            self._total(row[2], row[3], *row[5:])
+
+    def _total(self, restaurant: str, courier_id: str, orders: int, packages: int, price: int):
+        totals = [(self.restaurants, restaurant)]
+        if courier_id and courier_id != 'None':
+            totals.append((self.couriers, courier_id))
+        for target, key in totals:
+            total = target.setdefault(key, [0, 0, 0])
+            total[0] += orders
+            total[1] += packages
+            total[2] += price
+            if total[0] <= 0:
+                del target[key]
+
+    @staticmethod
+    def _key(record: dict) -> tuple:
+        return (record['date'], record['user_id'], record['restaurant'],
+                record['courier_id'], record['status'])
+
+    def _bump(self, record: dict, sign: int):
+        key = self._key(record)
+        day = self.days.setdefault(key[0], {})
+        bucket = day.setdefault(key, [0, 0, 0])
+        packages = sign * to_int(record['packages'])
+        price = sign * to_int(record['price'])
+        bucket[0] += sign
+        bucket[1] += packages
+        bucket[2] += price
+        self._total(key[2], key[3], sign, packages, price)
+        if bucket[0] <= 0:
+            del day[key]
+            if not day:
+                del self.days[key[0]]
+            self.db.execute(
+                'DELETE FROM order_stats WHERE day=? AND user_id=? AND restaurant=? '
+                'AND courier_id=? AND status=?', key
+            )
+        else:
+            self.db.execute('INSERT OR REPLACE INTO order_stats VALUES (?, ?, ?, ?, ?, ?, ?, ?)', key + tuple(bucket))
+
+    # add/remove/replace не фиксируют транзакцию: это делает OrderStore
+    # вместе с изменением самого заказа
+
+    def add(self, record: dict):
+        self._bump(record, 1)
+
+    def remove(self, record: dict):
+        self._bump(record, -1)
+
+    def replace(self, old: dict, new: dict):
+        self._bump(old, -1)
+        self._bump(new, 1)
+
+    def rebuild(self, records):
+        self.days = {}
+        self.restaurants = {}
+        self.couriers = {}
+        self.db.execute('DELETE FROM order_stats')
+        for record in records:
+            self._bump(record, 1)
+        self.db.commit()
+
+    def items(self, start_day: str = None, end_day: str = None, user_id: int = None):
+        """Корзины за период [start_day, end_day], при необходимости одного заведения"""
+        if start_day is not None and start_day == end_day:
+            days = [self.days.get(start_day, {})]
+        else:
+            days = [
+                buckets for day, buckets in self.days.items()
+                if (start_day is None or day >= start_day) and (end_day is None or day <= end_day)
+            ]
+        for buckets in days:
+            for key, bucket in buckets.items():
+                if user_id is None or key[1] == str(user_id):
+                    yield key, bucket
+
+    def period_totals(self, start_day: str, end_day: str):
+        """(заведение, курьер, статус, посылки, сумма) за период по дневным сводкам"""
+        totals = {}
+        for (_, _, restaurant, courier_id, status), (_, packages, price) in self.items(start_day, end_day):
+            key = (restaurant, None if courier_id == 'None' else courier_id, status)
+            total = totals.setdefault(key, [0, 0])
+            total[0] += packages
+            total[1] += price
+        return [key + tuple(total) for key, total in totals.items()]
+
+    def full_totals(self):
+        """({заведение: [посылки, сумма]}, {курьер: [посылки, сумма]}) за всю историю"""
+        return (
+            {restaurant: total[1:] for restaurant, total in self.restaurants.items()},
+            {courier_id: total[1:] for courier_id, total in self.couriers.items()}
+        )
+
+
+ORDER_COLUMNS = {
+    'id': 'id',
+    'user_id': 'user_id',
+    'restaurant': 'restaurant',
+    'time': 'time',
+    'packages': 'packages',
+    'distances': 'distances',
+    'price': 'price',
+    'status': 'status',
+    'date': 'order_date',
+    'created': 'order_time',
+    'courier_id': 'courier_id'
+}
+
+
+def order_to_row(record: dict) -> tuple:
+    courier_id = str(record['courier_id'])
+    return (
+        record['id'], to_int(record['user_id']), record['restaurant'], record['time'],
+        to_int(record['packages']), record['distances'], to_int(record['price']),
+        record['status'], record['date'], record['created'],
+        int(courier_id) if courier_id.isdigit() else None
+    )
+
+
+def order_from_row(row) -> dict:
+    record = dict(zip(ORDER_FIELDS, ('None' if value is None else str(value) for value in row)))
+    return record
+
+
+# Поля, из которых складываются агрегаты OrderStats
+ORDER_STATS_FIELDS = ('user_id', 'restaurant', 'packages', 'price', 'status', 'date', 'courier_id')
+ORDER_NUMERIC_FIELDS = ('packages', 'price')
+ORDER_UNIQUE_FIELDS = ('id', 'distances', 'created')  # значения почти не повторяются, не кэшируем
+
+
+def order_lines(buffer):
+    """(начало, конец) непустых строк в bytes или mmap, без копирования буфера"""
+    position = 0
+    size = len(buffer)
+    while position < size:
+        end = buffer.find(b'\n', position)
+        if end < 0:
+            end = size
+        if end > position:
+            yield position, end
+        position = end + 1
+
+
+def scan_orders(f, fields=ORDER_STATS_FIELDS):
+    """Записи заказов из бинарного файла строк 'поле|поле|...', только с полями fields.
+
+    Строка режется как bytes до последнего нужного поля, packages и price
+    сразу становятся int, а повторяющиеся значения (заведения, статусы,
+    даты, курьеры) декодируются один раз и дальше переиспользуются.
+    """
+    columns = [(field, ORDER_FIELDS.index(field)) for field in fields]
+    last = max(index for _, index in columns)
+    numeric = [(field, index) for field, index in columns if field in ORDER_NUMERIC_FIELDS]
+    unique = [(field, index) for field, index in columns if field in ORDER_UNIQUE_FIELDS]
+    repeated = [(field, index) for field, index in columns
+                if field not in ORDER_NUMERIC_FIELDS and field not in ORDER_UNIQUE_FIELDS]
+    padding = [b'None'] * (last + 1)
+    decoded = {}
+    for line in f:
+        line = line.rstrip(b'\n')
+        if not line:
+            continue
+        parts = line.split(b'|', last + 1)
+        if len(parts) <= last:
+            parts += padding[len(parts):]
+        record = {}
+        for field, index in repeated:
+            value = parts[index]
+            text = decoded.get(value)
+            if text is None:
+                text = decoded[value] = value.decode('utf-8')
+            record[field] = text
+        for field, index in unique:
+            record[field] = parts[index].decode('utf-8')
+        for field, index in numeric:
+            value = parts[index]
+            record[field] = int(value) if value.isdigit() else 0
+        yield record
+
+
+def import_orders_file(db: sqlite3.Connection, filename: str = ORDERS_FILE) -> int:
+    """Однократно переносит заказы из orders.txt в таблицу orders.
+
+    Файл читается как журнал (последняя строка заказа побеждает, 'removed'
+    удаляет заказ) и после переноса переименовывается в *.imported. Файл
+    отображается в память: первый проход запоминает только смещения
+    последней строки каждого заказа, второй разбирает эти строки по одной
+    прямо при вставке, так что весь журнал в памяти не собирается.
+    """
+    if not os.path.exists(filename) or not os.path.getsize(filename):
+        return 0
+    status_index = ORDER_FIELDS.index('status')
+
+    def full_record(line: bytes) -> dict:
+        parts = line.decode('utf-8').split('|')
+        while len(parts) < len(ORDER_FIELDS):
+            parts.append('None')
+        return dict(zip(ORDER_FIELDS, parts))
+
+    with open(filename, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+        latest = {}  # id -> (смещение первой строки, начало и конец последней)
+        for start, end in order_lines(buffer):
+            parts = buffer[start:end].split(b'|', status_index + 1)
+            order_id = parts[0]
+            if not order_id:
+                continue
+            if len(parts) > status_index and parts[status_index] == b'removed':
+                latest.pop(order_id, None)
+            else:
+                first = latest.get(order_id)
+                latest[order_id] = (first[0] if first else start, start, end)
+        # Порядок вставки — порядок первого появления заказа, как у прежнего чтения в dict
+        db.executemany(
+            'INSERT OR IGNORE INTO orders VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (order_to_row(full_record(buffer[start:end])) for _, start, end in sorted(latest.values()))
+        )
+        imported = len(latest)
+    db.commit()
+    os.replace(filename, f"{filename}.imported")
+    logger.info(f"Imported {imported} orders from {filename}")
+    return imported
+
+
+class RestaurantIndex:
+    """Вторичный индекс горячих заказов по заведению.
+
+    Для каждого заведения хранит его принятые заказы, упорядоченные по
+    номеру создания (как rowid в прежнем запросе): последний принятый
+    берётся с конца за O(1). Ещё хранит суммы дня по статусам,
+    так что отчёт заведения за день берётся из готовых сумм, без запросов
+    по всей таблице. Индекс поддерживает OrderStore при каждом изменении
+    заказа.
+    """
+
+    def __init__(self):
+        self.seq = 0
+        self.created = {}  # order_id -> порядковый номер создания
+        self.accepted = {}  # user_id -> {order_id: номер создания}
+        self.totals = {}  # (user_id, день) -> {статус: [заказы, посылки, сумма]}
+
+    def rebuild(self, records):
+        self.seq = 0
+        self.created = {}
+        self.accepted = {}
+        self.totals = {}
+        for record in records:
+            self.add(record)
+
+    def _bump(self, record: dict, sign: int):
+        key = (to_int(record['user_id']), record['date'])
+        statuses = self.totals.setdefault(key, {})
+        bucket = statuses.setdefault(record['status'], [0, 0, 0])
+        bucket[0] += sign
+        bucket[1] += sign * to_int(record['packages'])
+        bucket[2] += sign * to_int(record['price'])
+        if bucket[0] <= 0:
+            del statuses[record['status']]
+            if not statuses:
+                del self.totals[key]
+
+    def _accept(self, record: dict, sign: int):
+        user_id = to_int(record['user_id'])
+        if sign > 0:
+            accepted = self.accepted.setdefault(user_id, {})
+            seq = self.created.get(record['id'], 0)
+            if accepted and accepted[next(reversed(accepted))] > seq:
+                # Принят заказ старше последнего принятого: восстанавливаем порядок создания
+                accepted[record['id']] = seq
+                self.accepted[user_id] = dict(sorted(accepted.items(), key=lambda item: item[1]))
+            else:
+                accepted[record['id']] = seq
+            return
+        accepted = self.accepted.get(user_id)
+        if accepted is not None:
+            accepted.pop(record['id'], None)
+            if not accepted:
+                del self.accepted[user_id]
+
+    def add(self, record: dict):
+        # add() идёт в порядке создания: при rebuild — по rowid, дальше — по мере вставки
+        self.seq += 1
+        self.created[record['id']] = self.seq
+        if record['status'] == 'accepted':
+            self._accept(record, 1)
+        self._bump(record, 1)
+
+    def replace(self, old: dict, new: dict):
+        if old['status'] == 'accepted' and new['status'] != 'accepted':
+            self._accept(old, -1)
+        elif new['status'] == 'accepted' and old['status'] != 'accepted':
+            self._accept(new, 1)
+        self._bump(old, -1)
+        self._bump(new, 1)
+
+    def remove(self, record: dict):
+        self.created.pop(record['id'], None)
+        if record['status'] == 'accepted':
+            self._accept(record, -1)
+        self._bump(record, -1)
+
+    def last_accepted(self, user_id: int):
+        accepted = self.accepted.get(user_id)
+        return next(reversed(accepted)) if accepted else None
+
+    def day_totals(self, user_id: int, day: str) -> list:
+        """(статус, посылки, сумма) заведения за день"""
+        statuses = self.totals.get((user_id, day), {})
+        return [(status, bucket[1], bucket[2]) for status, bucket in sorted(statuses.items())]
+
+
+class OrderStore:
+    """Заказы в таблице orders с кэшем id -> запись в памяти.
+
+    Все изменения заказов идут через этот класс: строка в orders и
+    агрегаты OrderStats обновляются в одной транзакции, а кэш остаётся
+    согласованным с базой. Записи отдаются словарями строк в прежнем
+    формате orders.txt ('None' для пустого курьера).
+    """
+
+    def __init__(self, db: sqlite3.Connection, stats: OrderStats = None):
+        self.db = db
+        self.stats = stats
+        self.orders = {}
+        self.index = RestaurantIndex()
+        self.batching = False
+        self.db.execute('''CREATE TABLE IF NOT EXISTS orders
+                     (id TEXT PRIMARY KEY,
+                      user_id INTEGER,
+                      restaurant TEXT,
+                      time TEXT,
+                      packages INTEGER,
+                      distances TEXT,
+                      price INTEGER,
+                      status TEXT,
+                      order_date TEXT,
+                      order_time TEXT,
+                      courier_id INTEGER)''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS idx_orders_user_date ON orders (user_id, order_date)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS idx_orders_date ON orders (order_date)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS idx_orders_status ON orders (status)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS idx_orders_courier ON orders (courier_id)')
+        self.db.commit()
+        self.db.execute('''CREATE TABLE IF NOT EXISTS order_archive
+                     (day TEXT,
+                      part INTEGER,
+                      path TEXT,
+                      archived_at TEXT,
+                      PRIMARY KEY (day, part))''')
+        self.db.commit()
+        try:
+            import_orders_file(self.db)
+        except Exception as e:
+            logger.error(f"Orders import error: {e}")
+        if self.stats is not None and not self.stats.days:
+            self.stats.rebuild(itertools.chain(
+                self.read_archive(fields=ORDER_STATS_FIELDS),
+                (order_from_row(row) for row in self.db.execute('SELECT * FROM orders'))
+            ))
+        self.index.rebuild(order_from_row(row) for row in self.db.execute('SELECT * FROM orders ORDER BY rowid'))
+
+    def _transaction(self):
+        # Внутри apply_batch транзакцию фиксирует пачка целиком
+        return nullcontext() if self.batching else self.db
+
+    def apply_batch(self, ops: list) -> list:
+        """Выполняет изменения [(метод, args, kwargs)] одной транзакцией.
+
+        Каждое изменение идёт под своим SAVEPOINT: исключение откатывает
+        только его и возвращается в списке результатов на его месте.
+        """
+        results = []
+        self.batching = True
+        try:
+            with self.db:
+                if not self.db.in_transaction:
+                    self.db.execute('BEGIN')
+                for func, args, kwargs in ops:
+                    self.db.execute('SAVEPOINT order_op')
+                    try:
+                        results.append(func(*args, **kwargs))
+                    except Exception as e:
+                        self.db.execute('ROLLBACK TO order_op')
+                        results.append(e)
+                    self.db.execute('RELEASE order_op')
+        except Exception:
+            # Пачка не зафиксирована, а кэш, индекс и агрегаты уже изменены
+            self.resync()
+            raise
+        finally:
+            self.batching = False
+        return results
+
+    def resync(self):
+        """Перечитывает кэш, индекс и агрегаты из базы после неудачной фиксации"""
+        self.orders = {}
+        self.index.rebuild(order_from_row(row) for row in self.db.execute('SELECT * FROM orders ORDER BY rowid'))
+        if self.stats is not None:
+            self.stats.rebuild(itertools.chain(
+                self.read_archive(fields=ORDER_STATS_FIELDS),
+                (order_from_row(row) for row in self.db.execute('SELECT * FROM orders'))
+            ))
+
+    def get(self, order_id: str):
+        record = self.orders.get(order_id)
+        if record is None:
+            row = self.db.execute('SELECT * FROM orders WHERE id=?', (order_id,)).fetchone()
+            if row:
+                record = self.orders[order_id] = order_from_row(row)
+        return record
+
+    def add(self, record: dict):
+        record = {key: str(value) for key, value in record.items()}
+        with self._transaction():
+            self.db.execute('INSERT INTO orders VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', order_to_row(record))
+            if self.stats is not None:
+                self.stats.add(record)
+        self.orders[record['id']] = record
+        self.index.add(record)
+
+    def update(self, order_id: str, **fields):
+        record = self.get(order_id)
+        if record is None:
+            return None
+        new = {**record, **{key: str(value) for key, value in fields.items()}}
+        row = dict(zip(ORDER_FIELDS, order_to_row(new)))
+        with self._transaction():
+            self.db.execute(
+                f"UPDATE orders SET {', '.join(f'{ORDER_COLUMNS[key]}=?' for key in fields)} WHERE id=?",
+                [row[key] for key in fields] + [order_id]
+            )
+            if self.stats is not None:
+                self.stats.replace(record, new)
+        self.index.replace(record, new)
+        record.update(new)
+        return record
+
+    def claim(self, order_id: str, courier_id: int) -> bool:
+        """Отдаёт заказ курьеру, если его ещё никто не принял.
+
+        Условный UPDATE срабатывает, только пока заказ ждёт ответа, так что
+        из нескольких accept_ на один заказ выигрывает ровно первый.
+        """
+        record = self.get(order_id)
+        if record is None:
+            return False
+        new = {**record, 'status': 'accepted', 'courier_id': str(courier_id)}
+        with self._transaction():
+            claimed = self.db.execute(
+                "UPDATE orders SET status='accepted', courier_id=? WHERE id=? AND status IN ('pending', 'declined')",
+                (courier_id, order_id)
+            ).rowcount
+            if claimed and self.stats is not None:
+                self.stats.replace(record, new)
+        if claimed:
+            self.index.replace(record, new)
+            record.update(new)
+        return bool(claimed)
+
+    def extend(self, order_id: str, packages: int, distances: list, price: int):
+        """Добавляет к заказу посылки, расстояния и стоимость за один вызов в потоке storage"""
+        record = self.get(order_id)
+        if record is None:
+            return None
+        return self.update(
+            order_id,
+            packages=to_int(record['packages']) + packages,
+            distances=', '.join([record['distances'], *distances]),
+            price=to_int(record['price']) + price
+        )
+
+    def remove(self, order_id: str):
+        record = self.get(order_id)
+        if record is not None:
+            with self._transaction():
+                self.db.execute('DELETE FROM orders WHERE id=?', (order_id,))
+                if self.stats is not None:
+                    self.stats.remove(record)
+            self.orders.pop(order_id, None)
+            self.index.remove(record)
+
+    def accepted(self):
+        return [order_from_row(row) for row in self.db.execute("SELECT * FROM orders WHERE status='accepted'")]
+
+    def accepted_by_courier(self, courier_id: int):
+        rows = self.db.execute(
+            "SELECT * FROM orders WHERE courier_id=? AND status='accepted'", (courier_id,)
+        ).fetchall()
+        return [order_from_row(row) for row in rows]
+
+    def last_accepted(self, user_id: int):
+        order_id = self.index.last_accepted(user_id)
+        return self.get(order_id) if order_id else None
+
+    def restaurant_totals(self, user_id: int, day: str):
+        """(статус, посылки, сумма) заведения за день"""
+        return self.index.day_totals(user_id, day)
+
+    def restaurants_day_totals(self, day: str) -> dict:
+        """user_id -> [(статус, посылки, сумма)] всех заведений за день одним запросом"""
+        totals = {}
+        rows = self.db.execute(
+            '''SELECT user_id, status, SUM(packages), SUM(price)
+               FROM orders
+               WHERE order_date=?
+               GROUP BY user_id, status''',
+            (day,)
+        )
+        for user_id, status, packages, price in rows:
+            totals.setdefault(user_id, []).append((status, packages, price))
+        return totals
+
+    def evict(self):
+        # История остаётся в таблице, из памяти убираем только кэш
+        self.orders = {}
+
+    def rollover(self, before_day: str, archive_dir: str = ORDER_ARCHIVE_DIR) -> int:
+        """Переносит закрытые заказы всех дней раньше before_day в архив"""
+        days = [day for (day,) in self.db.execute(
+            'SELECT DISTINCT order_date FROM orders WHERE order_date < ? AND status IN (?, ?) ORDER BY order_date',
+            (before_day, *ORDER_CLOSED_STATUSES)
+        )]
+        return sum(self.archive_day(day, archive_dir) for day in days)
+
+    def archive_day(self, day: str, archive_dir: str = ORDER_ARCHIVE_DIR) -> int:
+        """Сжимает закрытые заказы дня в неизменяемый раздел архива и убирает их из orders.
+
+        Раздел пишется во временный файл и переименовывается после fsync,
+        так что на диске он либо целый, либо отсутствует. Принятые и
+        ожидающие заказы остаются в orders, пока не закроются; их заберёт
+        следующая часть раздела за тот же день.
+        Агрегаты OrderStats за этот день остаются как сводка раздела.
+        """
+        rows = self.db.execute(
+            'SELECT * FROM orders WHERE order_date=? AND status IN (?, ?) ORDER BY rowid',
+            (day, *ORDER_CLOSED_STATUSES)
+        ).fetchall()
+        if not rows:
+            return 0
+        records = [order_from_row(row) for row in rows]
+        part = self.db.execute('SELECT COUNT(*) FROM order_archive WHERE day=?', (day,)).fetchone()[0]
+        os.makedirs(archive_dir, exist_ok=True)
+        path = os.path.join(archive_dir, f"{day}.txt.gz" if not part else f"{day}.{part}.txt.gz")
+        with gzip.open(f"{path}.tmp", 'wt', encoding='utf-8') as f:
+            for record in records:
+                f.write('|'.join(record[field] for field in ORDER_FIELDS) + '\n')
+        with open(f"{path}.tmp", 'rb') as f:
+            os.fsync(f.fileno())
+        os.replace(f"{path}.tmp", path)
+        with self._transaction():
+            self.db.executemany('DELETE FROM orders WHERE id=?', [(record['id'],) for record in records])
+            self.db.execute(
+                'INSERT INTO order_archive (day, part, path, archived_at) VALUES (?, ?, ?, ?)',
+                (day, part, path, datetime.now(TIME_ZONE).isoformat(timespec='seconds'))
+            )
+        for record in records:
+            self.orders.pop(record['id'], None)
+            self.index.remove(record)
+        logger.info(f"Archived {len(records)} orders of {day} to {path}")
+        return len(records)
+
+    def read_archive(self, start_day: str = None, end_day: str = None, fields=ORDER_FIELDS):
+        """Записи заказов из разделов архива за период, только с полями fields (packages и price — int)"""
+        partitions = self.db.execute(
+            'SELECT path FROM order_archive WHERE day >= ? AND day <= ? ORDER BY day, part',
+            (start_day or '', end_day or '9999')
+        ).fetchall()
+        for (path,) in partitions:
+            with gzip.open(path, 'rb') as f:
+                yield from scan_orders(f, fields)
+
+
+order_stats = OrderStats(conn)
+order_store = OrderStore(conn, stats=order_stats)
+
+ORDER_COMMIT_WINDOW = 0.002  # секунд, за которые изменения заказов собираются в одну транзакцию
+ORDER_COMMIT_BATCH = 256
+
+
+class OrderWriter:
+    """Единственный писатель заказов с групповой фиксацией.
+
+    Обработчики не меняют OrderStore напрямую, а ставят изменение в
+    очередь и ждут подтверждения. Задача-писатель берёт первое изменение,
+    ещё ORDER_COMMIT_WINDOW собирает пришедшие следом и отдаёт пачку в
+    поток storage одной транзакцией (OrderStore.apply_batch), так что
+    fsync платится один раз на пачку. Подтверждение — результат метода
+    OrderStore или его исключение — приходит после COMMIT.
+    """
+
+    def __init__(self, store: OrderStore, window: float = ORDER_COMMIT_WINDOW, max_batch: int = ORDER_COMMIT_BATCH):
+        self.store = store
+        self.window = window
+        self.max_batch = max_batch
+        self.loop = None
+        self.queue = None
+        self.task = None
+        self.counters = {'batches': 0, 'mutations': 0, 'largest': 0}
+
+    def _ensure_started(self):
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            # Как у OutboundSender: очередь и задача-писатель живут в одном цикле событий
+            self.loop = loop
+            self.queue = asyncio.Queue()
+            self.task = None
+        if self.task is None or self.task.done():
+            self.task = loop.create_task(self._run())
+
+    def queue_depth(self) -> int:
+        return self.queue.qsize() if self.queue is not None else 0
+
+    async def submit(self, func, *args, **kwargs):
+        """Ставит вызов метода OrderStore в очередь и ждёт его фиксации"""
+        self._ensure_started()
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((func, args, kwargs, future))
+        return await future
+
+    async def _run(self):
+        while True:
+            batch = [await self.queue.get()]
+            if self.window:
+                await asyncio.sleep(self.window)
+            while len(batch) < self.max_batch and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            try:
+                results = await storage.run(self.store.apply_batch, [(func, args, kwargs) for func, args, kwargs, _ in batch])
+            except Exception as e:
+                logger.error(f"Order batch commit error: {e}")
+                results = [e] * len(batch)
+            for (_, _, _, future), result in zip(batch, results):
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+            self.counters['batches'] += 1
+            self.counters['mutations'] += len(batch)
+            self.counters['largest'] = max(self.counters['largest'], len(batch))
+
+    def stats(self) -> dict:
+        return {'queued': self.queue_depth(), **self.counters}
+
+
+order_writer = OrderWriter(order_store)
 
 async def save_order(order_data: dict):
     try:
         current_time = datetime.now(TIME_ZONE)
-        with open('orders.txt', 'a', encoding='utf-8') as f:
-            f.write(
-                f"{order_data['id']}|{order_data['user_id']}|{order_data['restaurant']}|"
-                f"{order_data['time']}|{order_data['packages']}|{', '.join(order_data['distances'])}|"
-                f"{order_data['price']}|pending|"
-                f"{current_time.strftime('%Y-%m-%d')}|"
-                f"{current_time.strftime('%H:%M:%S')}|None\n"
-            )
+        await order_writer.submit(order_store.add, {
+            'id': order_data['id'],
+            'user_id': str(order_data['user_id']),
+            'restaurant': order_data['restaurant'],
+            'time': order_data['time'],
+            'packages': str(order_data['packages']),
+            'distances': ', '.join(order_data['distances']),
+            'price': str(order_data['price']),
+            'status': 'pending',
+            'date': current_time.strftime('%Y-%m-%d'),
+            'created': current_time.strftime('%H:%M:%S'),
+            'courier_id': 'None'
+        })
     except Exception as e:
         logger.error(f"Order save error: {e}")
 
 async def update_order_status(order_id: str, new_status: str, courier_id: int = None):
     try:
-        with open('orders.txt', 'r+', encoding='utf-8') as f:
-            lines = []
-            for line in f:
-                if line.startswith(f"{order_id}|"):
-                    parts = line.strip().split('|')
-                    while len(parts) < 11:
-                        parts.append('None')
-                    parts[7] = new_status
-                    if courier_id:
-                        parts[10] = str(courier_id)
-                    line = '|'.join(parts) + '\n'
-                lines.append(line)
-            f.seek(0)
-            f.writelines(lines)
-            f.truncate()
+        if courier_id:
+            await order_writer.submit(order_store.update, order_id, status=new_status, courier_id=courier_id)
+        else:
+            await order_writer.submit(order_store.update, order_id, status=new_status)
     except Exception as e:
         logger.error(f"Order update error: {e}")
 
-async def send_to_courier(order: dict, keyboard: InlineKeyboardMarkup):
-    courier_id = next_courier()
-    if courier_id:
-        try:
-            # Получаем актуальное количество посылок из файла
-            with open('orders.txt', 'r', encoding='utf-8') as f:
-                for line in f:
-                    if line.startswith(f"{order['id']}|"):
-                        parts = line.strip().split('|')
-                        actual_packages = parts[4] if len(parts) > 4 else order['packages']
-                        break
-                else:
-                    actual_packages = order['packages']
-
-            await bot.send_message(
-                courier_id,
-                f"🚚 Новый заказ {order['id']}!\n"
-                f"🏢 {order['restaurant']}\n"
-                f"⏰ {order['time']}\n"
-                f"📦 {actual_packages} посылок\n"  # Используем актуальное количество
-                f"📍 {', '.join(order['distances'])}",
-                reply_markup=keyboard
-            )
-            return True
-        except Exception as e:
-            logger.error(f"Error sending to courier {courier_id}: {e}")
-            return await redirect_order(order['id'])
-    return False
-
-async def redirect_order(order_id: str):
-    order_data = None
-    with open('orders.txt', 'r', encoding='utf-8') as f:
-        for line in f:
-            if line.startswith(f"{order_id}|"):
-                parts = line.strip().split('|')
-                order_data = {
-                    'id': parts[0],
-                    'restaurant': parts[2],
-                    'time': parts[3],
-                    'packages': parts[4],
-                    'distances': parts[5].split(', '),
-                    'price': parts[6]
-                }
+async def offer_order(order_id: str, text: str, keyboard: InlineKeyboardMarkup, packages: int, exclude=()) -> list:
+    """Предлагает заказ сразу OFFER_FANOUT курьерам и возвращает тех, кому он ушёл.
+
+    Если сообщение курьеру не доставлено, берётся следующий. Заказ,
+    предложенный одному курьеру, сразу числится за ним в courier_load,
+    а при рассылке нескольким закрепляется только за принявшим.
+    """
+    tried = set(exclude)
+    offered = []
+    while len(offered) < OFFER_FANOUT:
+        couriers = []
+        while len(offered) + len(couriers) < OFFER_FANOUT:
+            courier_id = next_courier(tried)
+            if courier_id is None:
                 break
-    if not order_data:
-        logger.error(f"Order {order_id} not found for redirect")
-        return
-    courier_id = next_courier()
-    if courier_id:
-        try:
-            await bot.send_message(
-                courier_id,
-                f"🔄 Перенаправленный заказ {order_data['id']}!\n"
-                f"🏢 {order_data['restaurant']}\n"
-                f"⏰ {order_data['time']}\n"
-                f"📦 {order_data['packages']} посылок\n"
-                f"📍 {', '.join(order_data['distances'])}",
-                reply_markup=InlineKeyboardMarkup(inline_keyboard=[[
-                    InlineKeyboardButton(text="✅ Принять", callback_data=f"accept_{order_data['id']}"),
-                    InlineKeyboardButton(text="❌ Отказаться", callback_data=f"decline_{order_data['id']}")
-                ]])
-            )
-        except Exception as e:
-            logger.error(f"Error sending to courier {courier_id}: {e}")
-            return await redirect_order(order_id)
+            tried.add(courier_id)
+            couriers.append(courier_id)
+        if not couriers:
+            break
+        results = await asyncio.gather(*(
+            outbound.send(courier_id, text, reply_markup=keyboard, priority=PRIORITY_OFFER)
+            for courier_id in couriers
+        ), return_exceptions=True)
+        for courier_id, result in zip(couriers, results):
+            if isinstance(result, Exception):
+                logger.error(f"Error sending to courier {courier_id}: {result}")
+                continue
+            offer_board.add(order_id, courier_id, result.message_id)
+            offered.append(courier_id)
+    # Курьеры, которым не удалось написать, тоже больше не пробуются
+    offer_board.mark_tried(order_id, tried)
+    if len(offered) == 1:
+        courier_load.assign(order_id, offered[0], packages)
     else:
-        await bot.send_message(file_operation('admin_id.txt', 'r'), f"❗ Заказ {order_id} отклонен всеми!")
+        courier_load.release(order_id)
+    if offered:
+        acceptance_timers.schedule(order_id, ACCEPT_TIMEOUT, acceptance_expired, order_id)
+    return offered
+
+
+async def retract_offers(offers: dict, text: str):
+    """Заменяет текст снятых предложений, убирая у них кнопки"""
+    results = await asyncio.gather(*(
+        bot.edit_message_text(text, chat_id=courier_id, message_id=message_id)
+        for courier_id, message_id in offers.items()
+    ), return_exceptions=True)
+    for courier_id, result in zip(offers, results):
+        if isinstance(result, Exception):
+            logger.error(f"Error retracting offer for courier {courier_id}: {result}")
+
+
+def schedule_redirect(order_id: str, expired: bool = False):
+    """Ставит следующее перенаправление заказа с паузой по числу уже сделанных"""
+    delay = redirect_delay(offer_board.hops.get(order_id, 0) + 1)
+    acceptance_timers.schedule(order_id, delay, redirect_order, order_id, expired)
+
+
+async def redirect_order(order_id: str, expired: bool = False):
+    """Один шаг перенаправления: заказ уходит курьерам, которых для него ещё не пробовали.
+
+    Когда шаги (REDIRECT_MAX_HOPS) или курьеры кончаются, заказ снимается
+    с раздачи и помечается declined, а админ получает уведомление.
+    expired — перенаправление после истёкшего срока ответа: об ушедшем
+    дальше заказе тогда сообщается админу.
+    """
+    record = await storage.run(order_store.get, order_id)
+    if record is None or record['status'] not in ('pending', 'declined'):
+        logger.info(f"Order {order_id} is no longer waiting for a courier, redirect skipped")
+        return
+    hop = offer_board.next_hop(order_id)
+    offered = []
+    if hop <= REDIRECT_MAX_HOPS:
+        offered = await offer_order(
+            order_id,
+            f"🔄 Перенаправленный заказ {record['id']}!\n"
+            f"🏢 {record['restaurant']}\n"
+            f"⏰ {record['time']}\n"
+            f"📦 {record['packages']} посылок\n"
+            f"📍 {record['distances']}",
+            InlineKeyboardMarkup(inline_keyboard=[[
+                InlineKeyboardButton(text="✅ Принять", callback_data=f"accept_{record['id']}"),
+                InlineKeyboardButton(text="❌ Отказаться", callback_data=f"decline_{record['id']}")
+            ]]),
+            to_int(record['packages']),
+            offer_board.tried_couriers(order_id)
+        )
+    if not offered:
+        _, _, hops = offer_board.close(order_id)
+        redirect_hops.observe(hops, 'exhausted')
+        logger.warning(f"Order {order_id} was not taken after {hops} redirects")
+        # Иначе заказ навсегда остаётся pending: в отчётах, в горячей таблице и доступным для claim
+        await order_writer.submit(order_store.update, order_id, status='declined')
+        await outbound.send(await read_admin_id(), f"❗ Заказ {order_id} отклонен всеми!")
+    elif expired and (admin_id := await read_admin_id()):
+        await outbound.send(
+            admin_id,
+            f"❗ Заказ {order_id} не был принят вовремя! Перенаправлен следующему курьеру."
+        )
 
 async def add_back_button(keyboard):
     if isinstance(keyboard, ReplyKeyboardMarkup):
         keyboard.keyboard.append([KeyboardButton(text="◀️ Назад")])
     return keyboard
 
-@dp.message(lambda message: message.text == "◀️ Назад")
+text_routes = {}  # текст кнопки -> (обработчик, нужен ли state)
+
+def text_command(*texts: str):
+    """Регистрирует обработчик кнопки по точному тексту.
+
+    Все кнопки разбирает один route_text_command поиском в словаре, так
+    что цена диспетчеризации не зависит от размера меню, а повторная
+    регистрация того же текста сразу даёт ошибку.
+    """
+    def decorator(handler):
+        takes_state = 'state' in inspect.signature(handler).parameters
+        for text in texts:
+            if text in text_routes:
+                raise ValueError(f"Text command {text!r} is already handled by {text_routes[text][0].__name__}")
+            text_routes[text] = (handler, takes_state)
+        return handler
+    return decorator
+
+class TextCommand(BaseFilter):
+    async def __call__(self, message: types.Message):
+        route = text_routes.get(message.text)
+        return {'text_route': route} if route else False
+
+@dp.message(TextCommand())
+async def route_text_command(message: types.Message, state: FSMContext, text_route):
+    handler, takes_state = text_route
+    if takes_state:
+        await handler(message, state)
+    else:
+        await handler(message)
+
+@text_command("◀️ Назад")
 async def handle_back(message: types.Message, state: FSMContext):
     current_state = await state.get_state()
     data = await state.get_data()
@@ -272,6 +2008,8 @@ async def handle_back(message: types.Message, state: FSMContext):
         else:
             await state.set_state(state_flow[current_state])
             await handle_state_return(message, state_flow[current_state])
+    elif await is_admin(message.from_user.id):
+        await back_from_manage_couriers(message)
 
 async def handle_state_return(message: types.Message, return_state: State):
     if return_state == Form.tariff:
@@ -311,7 +2049,7 @@ async def handle_state_return(message: types.Message, return_state: State):
         )
 
 async def show_restaurant_menu(user_id: int):
-    last_order = get_last_order_for_restaurant(user_id)
+    last_order = await storage.run(get_last_order_for_restaurant, user_id)
     buttons = []
     if last_order:
         buttons.append([KeyboardButton(text="Добавить к этому заказу")])
@@ -319,7 +2057,7 @@ async def show_restaurant_menu(user_id: int):
         [KeyboardButton(text="Создать новый заказ")],
         [KeyboardButton(text="Получить отчёт")]
     ])
-    await bot.send_message(
+    await outbound.send(
         user_id,
         "Выберите действие:",
         reply_markup=ReplyKeyboardMarkup(
@@ -330,8 +2068,7 @@ async def show_restaurant_menu(user_id: int):
 
 def get_restaurant_tariff(user_id: int):
     try:
-        row = conn.execute('SELECT tariff FROM restaurants WHERE user_id=?', (user_id,)).fetchone()
-        return row[0] if row else '7/8'
+        return directory.restaurant_tariff(user_id) or '7/8'
     except:
         return '7/8'
 
@@ -364,24 +2101,27 @@ async def set_tariff(message: types.Message, state: FSMContext):
     await state.set_state(Form.restaurant_name)
     await message.answer("🏢 Введите название вашего заведения:", reply_markup=types.ReplyKeyboardRemove())
 
-@dp.message(Form.restaurant_name)
-async def set_restaurant(message: types.Message, state: FSMContext):
-    data = await state.get_data()
-    tariff = data.get('tariff', '7/8')
+def save_restaurant(user_id: int, name: str, tariff: str):
     current_date = datetime.now(TIME_ZONE).strftime("%Y-%m-%d")
     conn.execute(
         'INSERT OR REPLACE INTO restaurants VALUES (?, ?, ?, ?)',
-        (message.from_user.id, message.text, tariff, current_date)
+        (user_id, name, tariff, current_date)
     )
     conn.commit()
+    directory.invalidate()
+
+@dp.message(Form.restaurant_name)
+async def set_restaurant(message: types.Message, state: FSMContext):
+    data = await state.get_data()
+    tariff = data.get('tariff', '7/8')
+    await storage.run(save_restaurant, message.from_user.id, message.text, tariff)
     await state.clear()
     await message.answer(f"✅ Регистрация завершена! Ваше заведение: {message.text}")
     await show_restaurant_menu(message.from_user.id)
 
-@dp.message(lambda message: message.text == "Создать новый заказ")
+@text_command("Создать новый заказ")
 async def restaurant_create_order(message: types.Message, state: FSMContext):
-    restaurant = conn.execute('SELECT name FROM restaurants WHERE user_id=?', (message.from_user.id,)).fetchone()
-    if not restaurant:
+    if not await storage.run(directory.restaurant_name, message.from_user.id):
         await message.answer("❗ Вы не зарегистрированы как заведение!")
         return
     await create_order_flow(message, state)
@@ -417,8 +2157,8 @@ async def set_time(message: types.Message, state: FSMContext):
 async def set_packages(message: types.Message, state: FSMContext):
     if message.text.isdigit() and 1 <= int(message.text) <= 5:
         await state.update_data(packages=int(message.text), current_package=1, distances=[])
-        await ask_distance(message)
         await state.set_state(Form.distance)
+        await ask_distance(message)
 
 async def ask_distance(message: types.Message):
     await message.answer(
@@ -453,8 +2193,7 @@ async def create_order(message: types.Message, state: FSMContext):
     data = await state.get_data()
     main_order_id = data.get('main_order_id')
     
-    restaurant = conn.execute('SELECT name FROM restaurants WHERE user_id=?', 
-                            (message.from_user.id,)).fetchone()[0]
+    restaurant = await storage.run(directory.restaurant_name, message.from_user.id)
     
     if main_order_id:
         await update_existing_order(main_order_id, message.from_user.id, data)
@@ -463,12 +2202,12 @@ async def create_order(message: types.Message, state: FSMContext):
         await show_restaurant_menu(message.from_user.id)
         return
 
-    tariff = get_restaurant_tariff(message.from_user.id)
+    tariff = await storage.run(get_restaurant_tariff, message.from_user.id)
     near_price, far_price = map(int, tariff.split('/'))
     PRICES = {"Ближнее": near_price, "Дальнее": far_price}
 
     order_data = {
-        'id': order_id_generator(),
+        'id': await storage.run(order_id_generator),
         'user_id': message.from_user.id,
         'restaurant': restaurant,
         'time': data['time'],
@@ -477,8 +2216,7 @@ async def create_order(message: types.Message, state: FSMContext):
         'price': sum(PRICES[d] for d in data['distances'])
     }
 
-    active_couriers = get_active_couriers()
-    if not active_couriers:
+    if not len(courier_registry):
         await message.answer("❌ Нет доступных курьеров! Заказ не будет создан.")
         await show_restaurant_menu(message.from_user.id)
         await state.clear()
@@ -508,37 +2246,36 @@ async def create_order(message: types.Message, state: FSMContext):
 
 async def remove_order(order_id: str):
     """Удаляет заказ из системы"""
+    acceptance_timers.cancel(order_id)
+    courier_load.release(order_id)
+    offers, _, _ = offer_board.close(order_id)
+    if offers:
+        await retract_offers(offers, f"❌ Заказ {order_id} отменён")
     try:
-        with open('orders.txt', 'r', encoding='utf-8') as f:
-            lines = [line for line in f if not line.startswith(f"{order_id}|")]
-        
-        with open('orders.txt', 'w', encoding='utf-8') as f:
-            f.writelines(lines)
+        await order_writer.submit(order_store.remove, order_id)
     except Exception as e:
         logger.error(f"Error removing order: {e}")
 
 async def send_to_courier(order: dict, keyboard: InlineKeyboardMarkup):
-    courier_id = next_courier()
-    if courier_id:
-        try:
-            await bot.send_message(
-                courier_id,
-                f"🚚 Новый заказ {order['id']}!\n"
-                f"🏢 {order['restaurant']}\n"
-                f"⏰ {order['time']}\n"
-                f"📦 {order['packages']} посылок\n"
-                f"📍 {', '.join(order['distances'])}",
-                reply_markup=keyboard
-            )
-            return True
-        except Exception as e:
-            logger.error(f"Error sending to courier {courier_id}: {e}")
-            return await redirect_order(order['id'])
-    return False
+    # Получаем актуальное количество посылок из хранилища
+    record = await storage.run(order_store.get, order['id'])
+    actual_packages = record['packages'] if record else order['packages']
+
+    offered = await offer_order(
+        order['id'],
+        f"🚚 Новый заказ {order['id']}!\n"
+        f"🏢 {order['restaurant']}\n"
+        f"⏰ {order['time']}\n"
+        f"📦 {actual_packages} посылок\n"
+        f"📍 {', '.join(order['distances'])}",
+        keyboard,
+        to_int(actual_packages)
+    )
+    return bool(offered)
     
-@dp.message(lambda message: message.text == "Добавить к этому заказу")
+@text_command("Добавить к этому заказу")
 async def add_to_existing_order(message: types.Message, state: FSMContext):
-    last_order = get_last_order_for_restaurant(message.from_user.id)
+    last_order = await storage.run(get_last_order_for_restaurant, message.from_user.id)
     if last_order:
         await create_order_flow(message, state, last_order['id'])
     else:
@@ -546,26 +2283,19 @@ async def add_to_existing_order(message: types.Message, state: FSMContext):
         await show_restaurant_menu(message.from_user.id)
 
 
-@dp.message(lambda message: message.text == "ПОЛУЧИТЬ ОТЧЁТ")
+@text_command("ПОЛУЧИТЬ ОТЧЁТ")
 async def send_report(message: types.Message):
-    admin_id = file_operation('admin_id.txt', 'r')
-    if str(message.from_user.id) == str(admin_id):
-        try:
-            report = await generate_report()
-            await message.answer(report)
-        except Exception as e:
-            logger.error(f"Admin report error: {e}")
-            await message.answer("❌ Ошибка формирования отчёта")
+    if await is_admin(message.from_user.id):
+        await send_admin_report(message)
     else:
         await send_restaurant_report(message)
 
 
-@dp.message(lambda message: message.text == "Получить отчёт")
+@text_command("Получить отчёт")
 async def send_restaurant_report(message: types.Message):
     try:
         user_id = message.from_user.id
-        restaurant = conn.execute('SELECT name FROM restaurants WHERE user_id=?', (user_id,)).fetchone()
-        if not restaurant:
+        if not await storage.run(directory.restaurant_name, user_id):
             await message.answer("❗ Вы не зарегистрированы как заведение!")
             return
         
@@ -577,24 +2307,13 @@ async def send_restaurant_report(message: types.Message):
         await message.answer("❌ Ошибка формирования отчёта")
 
 
-@dp.message(lambda message: message.text == "Управление курьерами")
+@text_command("Управление курьерами")
 async def manage_couriers(message: types.Message):
-    if str(message.from_user.id) != file_operation('admin_id.txt', 'r'):
+    if not await is_admin(message.from_user.id):
         return
 
     # Получаем только активных курьеров (не заблокированных)
-    couriers = conn.execute('''
-        SELECT c.user_id, c.name 
-        FROM couriers c
-        WHERE c.user_id NOT IN (
-            SELECT user_id FROM blocked_couriers
-        )
-        AND c.user_id IN (
-            SELECT user_id FROM couriers
-            EXCEPT
-            SELECT user_id FROM blocked_couriers
-        )
-    ''').fetchall()
+    couriers = await storage.run(directory.unblocked_couriers)
 
     keyboard = []
     for courier_id, name in couriers:
@@ -610,34 +2329,26 @@ async def manage_couriers(message: types.Message):
         reply_markup=ReplyKeyboardMarkup(keyboard=keyboard, resize_keyboard=True)
     )
     
-@dp.message(lambda message: message.text.startswith("❌ Удалить курьера"))
+@dp.message(lambda message: (message.text or '').startswith("❌ Удалить курьера"))
 async def delete_courier(message: types.Message):
-    if str(message.from_user.id) != file_operation('admin_id.txt', 'r'):
+    if not await is_admin(message.from_user.id):
         return
     
     try:
         courier_id = int(message.text.split("(ID:")[1].strip(")").strip())
         
-        with open('orders.txt', 'r+', encoding='utf-8') as f:
-            lines = f.readlines()
-            f.seek(0)
-            for line in lines:
-                parts = line.strip().split('|')
-                if len(parts) > 10 and parts[10] == str(courier_id) and parts[7] == 'accepted':
-                    restaurant_id = parts[1]
-                    order_id = parts[0]
-                    await bot.send_message(
-                        restaurant_id,
-                        f"❌ Заказ {order_id} отменён, так как курьер был удалён"
-                    )
-                    line = line.replace('|accepted|', '|declined|')
-                f.write(line)
-            f.truncate()
+        for record in await storage.run(order_store.accepted_by_courier, courier_id):
+            courier_load.release(record['id'])
+            await order_writer.submit(order_store.update, record['id'], status='declined')
+            await outbound.send(
+                record['user_id'],
+                f"❌ Заказ {record['id']} отменён, так как курьер был удалён"
+            )
         
         remove_active_courier(courier_id)
-        add_blocked_courier(courier_id)
+        await storage.run(directory.block_courier, courier_id)
         
-        name = conn.execute('SELECT name FROM couriers WHERE user_id=?', (courier_id,)).fetchone()[0]
+        name = await storage.run(directory.courier_name, courier_id)
         
         await message.answer(
             f"✅ Курьер {name} успешно удален",
@@ -651,7 +2362,7 @@ async def delete_courier(message: types.Message):
         )
         
         try:
-            await bot.send_message(
+            await outbound.send(
                 courier_id,
                 "❌ Ваш аккаунт был деактивирован администратором"
             )
@@ -661,33 +2372,9 @@ async def delete_courier(message: types.Message):
         logger.error(f"Error deleting courier: {e}")
         await message.answer("❌ Ошибка при удалении курьера")
         
-@dp.message(lambda message: message.text == "◀️ Назад")
-async def admin_back(message: types.Message):
-    admin_id = file_operation('admin_id.txt', 'r')
-    if str(message.from_user.id) == str(admin_id):
-        try:
-            await message.delete()
-        except:
-            pass
-            
-        await message.answer(
-            "Главное меню администратора:",
-            reply_markup=ReplyKeyboardMarkup(
-                keyboard=[
-                    [KeyboardButton(text="ПОЛУЧИТЬ ОТЧЁТ")],
-                    [KeyboardButton(text="Управление курьерами")]
-                ],
-                resize_keyboard=True
-            )
-        )
-    else:
-        await message.answer("Доступ запрещен")
-        
-
-@dp.message(lambda message: message.text == "◀️ Назад в меню")
+@text_command("◀️ Назад в меню")
 async def back_from_manage_couriers(message: types.Message):
-    admin_id = file_operation('admin_id.txt', 'r')
-    if str(message.from_user.id) == str(admin_id):
+    if await is_admin(message.from_user.id):
         try:
             await message.delete()
         except:
@@ -706,10 +2393,8 @@ async def back_from_manage_couriers(message: types.Message):
     else:
         await message.answer("Доступ запрещен")
         
-@dp.message(lambda message: message.text == "ПОЛУЧИТЬ ОТЧЁТ")
 async def send_admin_report(message: types.Message):
-    admin_id = file_operation('admin_id.txt', 'r')
-    if str(message.from_user.id) == str(admin_id):
+    if await is_admin(message.from_user.id):
         try:
             # Отчёт за всю историю
             full_report = await generate_full_history_report()
@@ -718,6 +2403,7 @@ async def send_admin_report(message: types.Message):
             # Отчёт за текущую неделю
             weekly_report = await generate_report()
             await message.answer(f"📊 Отчёт за текущую неделю:\n\n{weekly_report}")
+            logger.info(f"Directory cache: {directory.stats()}")
             
         except Exception as e:
             logger.error(f"Admin report error: {e}")
@@ -727,15 +2413,14 @@ async def send_admin_report(message: types.Message):
 
 @dp.message(Form.courier_password)
 async def courier_auth(message: types.Message, state: FSMContext):
-    if message.from_user.id in get_blocked_couriers():
+    role = await user_role(message.from_user.id)
+    if role == ROLE_BLOCKED:
         await message.answer("❌ Ваш аккаунт заблокирован и не может быть зарегистрирован.")
         await state.clear()
         return
 
     if message.text == SECRET_PASSWORD:
-        couriers = get_couriers()
-        
-        if message.from_user.id not in couriers:
+        if role != ROLE_COURIER:
             await state.set_state(Form.courier_name)
             await message.answer("🔤 Придумайте себе имя (например: Курьер Женя):")
         else:
@@ -749,6 +2434,16 @@ async def courier_auth(message: types.Message, state: FSMContext):
         await message.answer("❌ Неверный пароль!")
         await state.clear()
 
+def save_courier(user_id: int, name: str):
+    current_date = datetime.now(TIME_ZONE).strftime("%Y-%m-%d")
+    conn.execute(
+        'INSERT OR REPLACE INTO couriers VALUES (?, ?, ?)',
+        (user_id, name, current_date)
+    )
+    conn.commit()
+    directory.invalidate()
+    file_operation('courier_id.txt', 'a', user_id)
+
 @dp.message(Form.courier_name)
 async def set_courier_name(message: types.Message, state: FSMContext):
     name = message.text.strip()
@@ -756,14 +2451,7 @@ async def set_courier_name(message: types.Message, state: FSMContext):
         await message.answer("❗ Имя должно быть от 2 до 30 символов. Попробуйте еще раз:")
         return
     
-    current_date = datetime.now(TIME_ZONE).strftime("%Y-%m-%d")
-    conn.execute(
-        'INSERT OR REPLACE INTO couriers VALUES (?, ?, ?)',
-        (message.from_user.id, name, current_date)
-    )
-    conn.commit()
-    
-    file_operation('courier_id.txt', 'a', message.from_user.id)
+    await storage.run(save_courier, message.from_user.id, name)
     await message.answer(
         f"✅ Регистрация завершена! Ваше имя: {name}",
         reply_markup=ReplyKeyboardMarkup(
@@ -787,56 +2475,40 @@ async def generate_report():
             'delivered_packages': 0  # Изменили с delivered_orders на delivered_packages
         }
 
-        with open('orders.txt', 'r', encoding='utf-8') as f:
-            for line in f:
-                parts = line.strip().split('|')
-                if len(parts) < 11:
-                    continue
+        start_day = (end_date - timedelta(days=6)).strftime("%Y-%m-%d")
+        end_day = end_date.strftime("%Y-%m-%d")
+
+        rows = await storage.run(order_stats.period_totals, start_day, end_day)
+        courier_names = await storage.run(directory.courier_names)
+        for restaurant, courier_id, status, packages, price in rows:
+            if restaurant not in report_data['restaurants']:
+                report_data['restaurants'][restaurant] = {
+                    'packages': 0,  # Изменили с orders на packages
+                    'price': 0,
+                    'delivered': 0
+                }
+            
+            report_data['restaurants'][restaurant]['packages'] += packages
+            report_data['restaurants'][restaurant]['price'] += price
+            if status == 'delivered':
+                report_data['restaurants'][restaurant]['delivered'] += packages
+            
+            if courier_id:
+                courier_name = courier_names.get(int(courier_id)) or f"Курьер {courier_id}"
                 
-                try:
-                    order_date = datetime.strptime(parts[8], "%Y-%m-%d").replace(tzinfo=TIME_ZONE)
-                except:
-                    continue
+                if courier_name not in report_data['couriers']:
+                    report_data['couriers'][courier_name] = {
+                        'packages': 0,  # Изменили с orders на packages
+                        'price': 0
+                    }
                 
-                if start_date <= order_date <= end_date:
-                    restaurant = parts[2]
-                    courier_id = parts[10] if len(parts) > 10 else None
-                    status = parts[7]
-                    packages = int(parts[4]) if parts[4].isdigit() else 0
-                    price = int(parts[6]) if parts[6].isdigit() else 0
-                    
-                    if restaurant not in report_data['restaurants']:
-                        report_data['restaurants'][restaurant] = {
-                            'packages': 0,  # Изменили с orders на packages
-                            'price': 0,
-                            'delivered': 0
-                        }
-                    
-                    report_data['restaurants'][restaurant]['packages'] += packages
-                    report_data['restaurants'][restaurant]['price'] += price
-                    if status == 'delivered':
-                        report_data['restaurants'][restaurant]['delivered'] += packages
-                    
-                    if courier_id and courier_id != 'None':
-                        courier_name = conn.execute(
-                            'SELECT name FROM couriers WHERE user_id=?', 
-                            (courier_id,)
-                        ).fetchone()
-                        courier_name = courier_name[0] if courier_name else f"Курьер {courier_id}"
-                        
-                        if courier_name not in report_data['couriers']:
-                            report_data['couriers'][courier_name] = {
-                                'packages': 0,  # Изменили с orders на packages
-                                'price': 0
-                            }
-                        
-                        report_data['couriers'][courier_name]['packages'] += packages
-                        report_data['couriers'][courier_name]['price'] += price
-                    
-                    report_data['total_packages'] += packages
-                    report_data['total_price'] += price
-                    if status == 'delivered':
-                        report_data['delivered_packages'] += packages
+                report_data['couriers'][courier_name]['packages'] += packages
+                report_data['couriers'][courier_name]['price'] += price
+            
+            report_data['total_packages'] += packages
+            report_data['total_price'] += price
+            if status == 'delivered':
+                report_data['delivered_packages'] += packages
 
         report_text = (
             f"📊 ОТЧЁТ АДМИНИСТРАТОРА\n"
@@ -875,43 +2547,28 @@ async def generate_full_history_report():
         total_price = 0
         restaurants = {}
         couriers = {}
+        # Корзины меняет поток storage (OrderWriter), поэтому обходим их там же
+        restaurant_totals, courier_totals = await storage.run(order_stats.full_totals)
+        courier_names = await storage.run(directory.courier_names)
         
-        with open('orders.txt', 'r', encoding='utf-8') as f:
-            for line in f:
-                parts = line.strip().split('|')
-                if len(parts) < 11:
-                    continue
-                
-                restaurant = parts[2]
-                courier_id = parts[10] if len(parts) > 10 else None
-                packages = int(parts[4]) if parts[4].isdigit() else 0  # Добавили подсчет посылок
-                price = int(parts[6]) if parts[6].isdigit() else 0
-                
-                if restaurant not in restaurants:
-                    restaurants[restaurant] = {
-                        'packages': 0,
-                        'price': 0
-                    }
-                restaurants[restaurant]['packages'] += packages
-                restaurants[restaurant]['price'] += price
-                
-                if courier_id and courier_id != 'None':
-                    courier_name = conn.execute(
-                        'SELECT name FROM couriers WHERE user_id=?', 
-                        (courier_id,)
-                    ).fetchone()
-                    courier_name = courier_name[0] if courier_name else f"Курьер {courier_id}"
-                    
-                    if courier_name not in couriers:
-                        couriers[courier_name] = {
-                            'packages': 0,
-                            'price': 0
-                        }
-                    couriers[courier_name]['packages'] += packages
-                    couriers[courier_name]['price'] += price
-                
-                total_packages += packages
-                total_price += price
+        for restaurant, (packages, price) in restaurant_totals.items():
+            restaurants[restaurant] = {
+                'packages': packages,
+                'price': price
+            }
+            total_packages += packages
+            total_price += price
+        
+        for courier_id, (packages, price) in courier_totals.items():
+            courier_name = courier_names.get(int(courier_id)) or f"Курьер {courier_id}"
+            
+            if courier_name not in couriers:
+                couriers[courier_name] = {
+                    'packages': 0,
+                    'price': 0
+                }
+            couriers[courier_name]['packages'] += packages
+            couriers[courier_name]['price'] += price
         
         report_text = (
             f"📊 ПОЛНЫЙ ОТЧЁТ (ВСЯ ИСТОРИЯ)\n"
@@ -945,66 +2602,55 @@ async def generate_full_history_report():
 
 async def generate_restaurant_report(user_id: int):
     try:
-        report_data = {
-            'packages': 0,
-            'price': 0,
-            'accepted_packages': 0,  # Добавили
-            'declined_packages': 0,  # Добавили
-            'pending_packages': 0,   # Добавили
-            'delivered_packages': 0
-        }
-
         today = datetime.now(TIME_ZONE).strftime("%Y-%m-%d")
-        restaurant_name = conn.execute('SELECT name FROM restaurants WHERE user_id=?', (user_id,)).fetchone()[0]
-        
-        with open('orders.txt', 'r', encoding='utf-8') as f:
-            for line in f:
-                parts = line.strip().split('|')
-                if len(parts) < 11:
-                    continue
-                if int(parts[1]) == user_id and parts[8] == today:
-                    packages = int(parts[4]) if parts[4].isdigit() else 0
-                    price = int(parts[6]) if parts[6].isdigit() else 0
-                    status = parts[7]
-                    
-                    report_data['packages'] += packages
-                    report_data['price'] += price
-                    
-                    # Добавляем подсчет по статусам с учетом количества посылок
-                    if status == 'accepted':
-                        report_data['accepted_packages'] += packages
-                    elif status == 'declined':
-                        report_data['declined_packages'] += packages
-                    elif status == 'pending':
-                        report_data['pending_packages'] += packages
-                    elif status == 'delivered':
-                        report_data['delivered_packages'] += packages
-        
-        report_text = (
-            f"📋 Отчёт заведения {restaurant_name} за {datetime.now(TIME_ZONE).strftime('%d.%m.%Y')}:\n\n"
-            f"• Всего посылок: {report_data['packages']}\n"
-            f"• Общая сумма: {report_data['price']} руб.\n"
-            f"• Принято курьерами: {report_data['accepted_packages']} посылок\n"
-            f"• Отклонено курьерами: {report_data['declined_packages']} посылок\n"
-            f"• Ожидает принятия: {report_data['pending_packages']} посылок\n"
-            f"• Успешно доставлено: {report_data['delivered_packages']} посылок\n"
-        )
-        
-        return report_text if report_data['packages'] > 0 else "❗ За сегодня посылок не было"
+        restaurant_name = await storage.run(directory.restaurant_name, user_id)
+        rows = await storage.run(order_store.restaurant_totals, user_id, today)
+        return format_restaurant_report(restaurant_name, rows)
     except Exception as e:
         logger.error(f"Restaurant report generation error: {e}")
         return "Не удалось сформировать отчёт"
 
+def format_restaurant_report(restaurant_name: str, rows) -> str:
+    report_data = {
+        'packages': 0,
+        'price': 0,
+        'accepted_packages': 0,  # Добавили
+        'declined_packages': 0,  # Добавили
+        'pending_packages': 0,   # Добавили
+        'delivered_packages': 0
+    }
+
+    for status, packages, price in rows:
+        report_data['packages'] += packages
+        report_data['price'] += price
+        
+        # Добавляем подсчет по статусам с учетом количества посылок
+        if status == 'accepted':
+            report_data['accepted_packages'] += packages
+        elif status == 'declined':
+            report_data['declined_packages'] += packages
+        elif status == 'pending':
+            report_data['pending_packages'] += packages
+        elif status == 'delivered':
+            report_data['delivered_packages'] += packages
+    
+    report_text = (
+        f"📋 Отчёт заведения {restaurant_name} за {datetime.now(TIME_ZONE).strftime('%d.%m.%Y')}:\n\n"
+        f"• Всего посылок: {report_data['packages']}\n"
+        f"• Общая сумма: {report_data['price']} руб.\n"
+        f"• Принято курьерами: {report_data['accepted_packages']} посылок\n"
+        f"• Отклонено курьерами: {report_data['declined_packages']} посылок\n"
+        f"• Ожидает принятия: {report_data['pending_packages']} посылок\n"
+        f"• Успешно доставлено: {report_data['delivered_packages']} посылок\n"
+    )
+    
+    return report_text if report_data['packages'] > 0 else "❗ За сегодня посылок не было"
+
 def get_last_order_for_restaurant(user_id: int):
     try:
-        if not os.path.exists('orders.txt'):
-            return None
-        with open('orders.txt', 'r', encoding='utf-8') as f:
-            lines = f.readlines()
-            for line in reversed(lines):
-                parts = line.strip().split('|')
-                if len(parts) >= 11 and int(parts[1]) == user_id and parts[7] == 'accepted':
-                    return {'id': parts[0], 'courier_id': parts[10]}
+        record = order_store.last_accepted(user_id)
+        if record:
+            return {'id': record['id'], 'courier_id': record['courier_id']}
         return None
     except Exception as e:
         logger.error(f"Error getting last order: {e}")
@@ -1013,63 +2659,59 @@ def get_last_order_for_restaurant(user_id: int):
 
 def get_courier_for_order(order_id: str):
     try:
-        with open('orders.txt', 'r', encoding='utf-8') as f:
-            for line in f:
-                if line.startswith(f"{order_id}|"):
-                    parts = line.strip().split('|')
-                    return int(parts[10]) if parts[10] != 'None' else None
+        record = order_store.get(order_id)
+        if record:
+            return int(record['courier_id']) if record['courier_id'] != 'None' else None
     except Exception:
         return None
 
 
 async def check_order_status(order_id: str) -> str:
-    with open('orders.txt', 'r', encoding='utf-8') as f:
-        for line in f:
-            if line.startswith(f"{order_id}|"):
-                parts = line.strip().split('|')
-                return parts[7]
+    record = await storage.run(order_store.get, order_id)
+    if record:
+        return record['status']
     return 'not_found'
 
 
-async def remind_courier(order_id: str):
-    await asyncio.sleep(9999)
-    if await check_order_status(order_id) == 'pending':
-        await redirect_order(order_id)
-        if admin_id := file_operation('admin_id.txt', 'r'):
-            await bot.send_message(
-                admin_id,
-                f"❗ Заказ {order_id} не был принят вовремя! Перенаправлен следующему курьеру."
-            )
+async def acceptance_expired(order_id: str):
+    """Срок ответа курьера истёк: заказ уходит следующим курьерам"""
+    if await check_order_status(order_id) in ('pending', 'declined'):
+        offers = offer_board.withdraw(order_id)
+        await retract_offers(offers, f"⌛ Время на ответ по заказу {order_id} истекло")
+        schedule_redirect(order_id, expired=True)
 
 
 async def update_existing_order(order_id: str, user_id: int, data: dict):
     try:
-        tariff = get_restaurant_tariff(user_id)
+        tariff = await storage.run(get_restaurant_tariff, user_id)
         near_price, far_price = map(int, tariff.split('/'))
         PRICES = {"Ближнее": near_price, "Дальнее": far_price}
 
-        pending_updates[order_id] = {
-            'added_packages': data['packages'],
-            'added_distances': data['distances'],
-            'added_price': sum(PRICES[d] for d in data['distances'])
-        }
+        addition_id = await storage.run(
+            pending_additions.add,
+            order_id,
+            user_id,
+            data['packages'],
+            data['distances'],
+            sum(PRICES[d] for d in data['distances'])
+        )
         
-        courier_id = get_courier_for_order(order_id)
+        courier_id = await storage.run(get_courier_for_order, order_id)
         if courier_id:
             try:
-                await bot.send_message(
+                await outbound.send(
                     courier_id,
                     f"➕ К заказу {order_id} добавлено:\n"
                     f"Посылки: {data['packages']}\n"
                     f"Расстояния: {', '.join(data['distances'])}",
                     reply_markup=InlineKeyboardMarkup(inline_keyboard=[[
-                        InlineKeyboardButton(text="✅ Подтвердить", callback_data=f"confirm_{order_id}"),
-                        InlineKeyboardButton(text="❌ Отменить", callback_data=f"cancel_{order_id}")
+                        InlineKeyboardButton(text="✅ Подтвердить", callback_data=f"confirm_{order_id}_{addition_id}"),
+                        InlineKeyboardButton(text="❌ Отменить", callback_data=f"cancel_{order_id}_{addition_id}")
                     ]])
                 )
             except Exception as e:
                 logger.error(f"Error sending to courier: {e}")
-                await bot.send_message(
+                await outbound.send(
                     user_id,
                     "❌ Не удалось уведомить курьера. Попробуйте создать новый заказ."
                 )
@@ -1079,56 +2721,46 @@ async def update_existing_order(order_id: str, user_id: int, data: dict):
 @dp.callback_query(lambda c: c.data.startswith(('confirm_', 'cancel_')))
 async def handle_additional_packages(callback: types.CallbackQuery):
     action, order_id = callback.data.split('_', 1)
+    order_id, _, addition_id = order_id.rpartition('_')
+    if order_id and addition_id.isdigit():
+        addition_id = int(addition_id)
+    else:
+        # Кнопки, отправленные до появления id добавления: берём самое старое
+        order_id = callback.data.split('_', 1)[1]
+        addition_id = await storage.run(pending_additions.first_for_order, order_id)
 
-    if order_id not in pending_updates:
+    update_data = await storage.run(pending_additions.pop, addition_id)
+    if update_data is None:
         await callback.answer("❗ Изменения уже обработаны")
         return
 
-    update_data = pending_updates.pop(order_id)
-
     try:
-        with open('orders.txt', 'r', encoding='utf-8') as f:
-            parts = None
-            for line in f:
-                if line.startswith(f"{order_id}|"):
-                    parts = line.strip().split('|')
-                    break
-            
-            if not parts:
-                raise Exception("Order not found")
-            
-            restaurant_id = int(parts[1])
+        record = await storage.run(order_store.get, order_id)
+        if not record:
+            raise Exception("Order not found")
+        
+        restaurant_id = int(record['user_id'])
         
         if action == 'confirm':
-            new_packages = int(parts[4]) + update_data['added_packages']
-            new_distances = parts[5] + ', ' + ', '.join(update_data['added_distances'])
-            new_price = int(parts[6]) + update_data['added_price']
-            
-            with open('orders.txt', 'r+', encoding='utf-8') as f:
-                lines = []
-                for line in f:
-                    if line.startswith(f"{order_id}|"):
-                        new_line = (
-                            f"{parts[0]}|{parts[1]}|{parts[2]}|{parts[3]}|"
-                            f"{new_packages}|{new_distances}|{new_price}|"
-                            f"{parts[7]}|{parts[8]}|{parts[9]}|{parts[10]}"
-                        )
-                        lines.append(new_line + '\n')
-                    else:
-                        lines.append(line)
-                
-                f.seek(0)
-                f.writelines(lines)
-                f.truncate()
+            # Чтение и запись в одном вызове: параллельные подтверждения не затирают друг друга
+            record = await order_writer.submit(
+                order_store.extend,
+                order_id,
+                update_data['packages'],
+                update_data['distances'],
+                update_data['price']
+            )
+            if record['courier_id'] != 'None':
+                courier_load.assign(order_id, int(record['courier_id']), to_int(record['packages']))
             
             await callback.answer("Дополнительные посылки подтверждены!")
-            await bot.send_message(
+            await outbound.send(
                 restaurant_id,
                 f"✅ Курьер подтвердил добавление к заказу {order_id}"
             )
         else:
             await callback.answer("Дополнительные посылки отменены!")
-            await bot.send_message(
+            await outbound.send(
                 restaurant_id,
                 f"❌ Курьер отклонил добавление к заказу {order_id}"
             )
@@ -1143,17 +2775,34 @@ async def handle_order_accept(callback: types.CallbackQuery):
     order_id = callback.data.split('_', 1)[1]
     courier_id = callback.from_user.id
 
-    await update_order_status(order_id, 'accepted', courier_id)
+    if not await order_writer.submit(order_store.claim, order_id, courier_id):
+        record = await storage.run(order_store.get, order_id)
+        if record and record['courier_id'] == str(courier_id):
+            # Повторное нажатие того же курьера: сообщение с кнопкой доставки не трогаем
+            await callback.answer(f"Вы уже приняли заказ {order_id}")
+            return
+        # Заказ уже принят другим курьером или снят
+        offer_board.remove(order_id, courier_id)
+        await callback.answer(f"Заказ {order_id} уже принят другим курьером")
+        try:
+            await callback.message.delete()
+        except Exception as e:
+            logger.error(f"Error removing stale offer: {e}")
+        return
+
+    acceptance_timers.cancel(order_id)
+    offers, waited, hops = offer_board.close(order_id)
+    offers.pop(courier_id, None)
+    if waited is not None:
+        accept_latency.observe(waited, 'fanout' if OFFER_FANOUT > 1 else 'single')
+        redirect_hops.observe(hops, 'accepted')
 
     try:
-        with open('orders.txt', 'r', encoding='utf-8') as f:
-            for line in f:
-                if line.startswith(f"{order_id}|"):
-                    parts = line.strip().split('|')
-                    restaurant_id = int(parts[1])
-                    break
+        record = await storage.run(order_store.get, order_id)
+        restaurant_id = int(record['user_id'])
+        courier_load.assign(order_id, courier_id, to_int(record['packages']))
         
-        await bot.send_message(
+        await outbound.send(
             restaurant_id,
             f"✅ Заказ {order_id} принят курьером @{callback.from_user.username}"
         )
@@ -1168,31 +2817,36 @@ async def handle_order_accept(callback: types.CallbackQuery):
     except Exception as e:
         logger.error(f"Error updating message: {e}")
         await callback.answer("Ошибка обновления статуса")
+    if offers:
+        await retract_offers(offers, f"✅ Заказ {order_id} принят другим курьером")
 @dp.callback_query(lambda c: c.data.startswith('decline_'))
 async def handle_order_decline(callback: types.CallbackQuery):
     order_id = callback.data.split('_', 1)[1]
+    offer_board.remove(order_id, callback.from_user.id)
 
-    await update_order_status(order_id, 'declined')
     await callback.message.delete()
     await callback.answer(f"Заказ {order_id} отклонен")
-    await redirect_order(order_id)
+    if offer_board.couriers(order_id) or await check_order_status(order_id) not in ('pending', 'declined'):
+        # Заказ ещё ждёт ответа других курьеров или уже принят
+        return
+    acceptance_timers.cancel(order_id)
+    courier_load.release(order_id)
+    await update_order_status(order_id, 'declined')
+    schedule_redirect(order_id)
 
 
 @dp.callback_query(lambda c: c.data.startswith('delivered_'))
 async def handle_delivery_confirmation(callback: types.CallbackQuery):
     order_id = callback.data.split('_', 1)[1]
 
+    courier_load.release(order_id)
     await update_order_status(order_id, 'delivered')
 
     try:
-        with open('orders.txt', 'r', encoding='utf-8') as f:
-            for line in f:
-                if line.startswith(f"{order_id}|"):
-                    parts = line.strip().split('|')
-                    restaurant_id = int(parts[1])
-                    break
+        record = await storage.run(order_store.get, order_id)
+        restaurant_id = int(record['user_id'])
         
-        await bot.send_message(
+        await outbound.send(
             restaurant_id,
             f"🚚 Заказ {order_id} был доставлен!"
         )
@@ -1204,9 +2858,9 @@ async def handle_delivery_confirmation(callback: types.CallbackQuery):
         await callback.answer("Ошибка обновления статуса")
 
 
-@dp.message(lambda message: message.text == "Начать смену")
+@text_command("Начать смену")
 async def start_shift(message: types.Message):
-    if message.from_user.id in get_blocked_couriers():
+    if await user_role(message.from_user.id) == ROLE_BLOCKED:
         await message.answer("❌ Ваш аккаунт заблокирован и не может работать курьером.")
         return
 
@@ -1221,7 +2875,7 @@ async def start_shift(message: types.Message):
     )
 
 
-@dp.message(lambda message: message.text == "Закрыть смену")
+@text_command("Закрыть смену")
 async def end_shift(message: types.Message):
     remove_active_courier(message.from_user.id)
 
@@ -1236,8 +2890,8 @@ async def end_shift(message: types.Message):
 
 @dp.message(CommandStart())
 async def start(message: types.Message, state: FSMContext):
-    admin_id = file_operation('admin_id.txt', 'r')
-    if str(message.from_user.id) == str(admin_id):
+    role = await user_role(message.from_user.id)
+    if role == ROLE_ADMIN:
         await message.answer(
             "👋 Добро пожаловать, администратор!",
             reply_markup=ReplyKeyboardMarkup(
@@ -1250,9 +2904,8 @@ async def start(message: types.Message, state: FSMContext):
         )
         return
 
-    couriers = get_couriers()
-    if message.from_user.id in couriers:
-        if message.from_user.id in get_active_couriers():
+    if role in (ROLE_COURIER, ROLE_BLOCKED):
+        if message.from_user.id in courier_registry:
             markup = ReplyKeyboardMarkup(
                 keyboard=[[KeyboardButton(text="Закрыть смену")]],
                 resize_keyboard=True
@@ -1265,8 +2918,7 @@ async def start(message: types.Message, state: FSMContext):
         await message.answer("👋 Добро пожаловать назад!", reply_markup=markup)
         return
 
-    restaurant = conn.execute('SELECT name FROM restaurants WHERE user_id=?', (message.from_user.id,)).fetchone()
-    if restaurant:
+    if role == ROLE_RESTAURANT:
         await show_restaurant_menu(message.from_user.id)
         return
 
@@ -1308,28 +2960,10 @@ async def process_role(message: types.Message, state: FSMContext):
             reply_markup=types.ReplyKeyboardRemove()
         )
 
-@dp.message(Form.courier_password)
-async def courier_auth(message: types.Message, state: FSMContext):
-    if message.text == SECRET_PASSWORD:
-        await state.set_state(Form.courier_name)
-        await message.answer("🔤 Придумайте себе имя (например: Курьер Женя):")
-    else:
-        await message.answer("❌ Неверный пароль!")
-        await state.clear()
-
-@dp.message(Form.restaurant_password)
-async def restaurant_auth(message: types.Message, state: FSMContext):
-    if message.text == SECRET_PASSWORD:
-        await state.set_state(Form.restaurant_name)
-        await message.answer("🏢 Введите название вашего заведения:")
-    else:
-        await message.answer("❌ Неверный пароль!")
-        await state.clear()
-        
 @dp.message(Form.admin_password)
 async def admin_auth(message: types.Message, state: FSMContext):
     if message.text == ADMIN_PASSWORD:
-        file_operation('admin_id.txt', 'w', message.from_user.id)
+        await storage.run(directory.set_admin, message.from_user.id)
         await message.answer(
             "👋 Добро пожаловать, администратор!",
             reply_markup=ReplyKeyboardMarkup(
@@ -1347,15 +2981,54 @@ async def admin_auth(message: types.Message, state: FSMContext):
 
 
 async def schedule_cleanup():
+    """Раз в сутки (и сразу после старта) переносит старые дни в архив.
+
+    Раз в минуту снимает просроченные добавления к заказам и сообщает о них заведению.
+    """
+    last_rollover = None
     while True:
-        now = datetime.now(TIME_ZONE)
-        if now.hour == 23 and now.minute == 59:
-            with open('orders.txt', 'w') as f:
-                f.truncate()
-            logger.info("Daily orders cleanup performed")
+        today = datetime.now(TIME_ZONE).date()
+        if today != last_rollover:
+            before_day = (today - timedelta(days=ORDER_HOT_DAYS)).strftime("%Y-%m-%d")
+            try:
+                archived = await order_writer.submit(order_store.rollover, before_day)
+                await storage.run(order_store.evict)
+                expired = await dp.storage.sweep()
+                last_rollover = today
+                logger.info(
+                    f"Daily rollover: {archived} orders archived before {before_day}, {expired} stale FSM states removed"
+                )
+            except Exception as e:
+                logger.error(f"Order rollover error: {e}")
+        try:
+            for addition in await storage.run(pending_additions.expire):
+                await outbound.send(
+                    addition['user_id'],
+                    f"⌛ Курьер не ответил на добавление к заказу {addition['order_id']}, изменения отменены"
+                )
+        except Exception as e:
+            logger.error(f"Pending additions expiry error: {e}")
         await asyncio.sleep(60)
 
 
+async def broadcast_messages(messages):
+    """Рассылает пары (chat_id, текст) через outbound с низшим приоритетом.
+
+    Темп, повторы и RetryAfter обрабатывает OutboundSender, здесь только
+    собираются итоги: возвращает (отправлено, ошибок).
+    """
+    results = await asyncio.gather(
+        *(outbound.send(chat_id, text, priority=PRIORITY_BULK) for chat_id, text in messages),
+        return_exceptions=True
+    )
+    failed = 0
+    for (chat_id, _), result in zip(messages, results):
+        if isinstance(result, Exception):
+            failed += 1
+            logger.error(f"Broadcast to {chat_id} failed: {result}")
+    return len(messages) - failed, failed
+
+
 async def send_weekly_report():
     while True:
         now = datetime.now(TIME_ZONE)
@@ -1372,17 +3045,23 @@ async def send_weekly_report():
         try:
             report = await generate_report()
             
-            admin_id = file_operation('admin_id.txt', 'r')
+            admin_id = await read_admin_id()
             if admin_id:
-                await bot.send_message(admin_id, f"📅 Еженедельный отчёт:\n\n{report}")
+                await outbound.send(admin_id, f"📅 Еженедельный отчёт:\n\n{report}", priority=PRIORITY_BULK)
             
-            restaurants = conn.execute('SELECT user_id, name FROM restaurants').fetchall()
-            for user_id, name in restaurants:
-                try:
-                    restaurant_report = await generate_restaurant_report(user_id)
-                    await bot.send_message(user_id, f"📅 Ваша недельная статистика:\n\n{restaurant_report}")
-                except Exception as e:
-                    logger.error(f"Ошибка отправки отчёта заведению {name}: {e}")
+            started = time.monotonic()
+            today = datetime.now(TIME_ZONE).strftime("%Y-%m-%d")
+            restaurants = await storage.run(lambda: conn.execute('SELECT user_id, name FROM restaurants').fetchall())
+            totals = await storage.run(order_store.restaurants_day_totals, today)
+            messages = [
+                (user_id, f"📅 Ваша недельная статистика:\n\n{format_restaurant_report(name, totals.get(user_id, []))}")
+                for user_id, name in restaurants
+            ]
+            sent, failed = await broadcast_messages(messages)
+            logger.info(
+                f"Weekly report: {sent} sent, {failed} failed "
+                f"in {time.monotonic() - started:.1f}s, outbound {outbound.stats()}"
+            )
                     
         except Exception as e:
             logger.error(f"Ошибка отправки еженедельного отчёта: {e}")
@@ -1393,30 +3072,176 @@ async def handle_unprocessed(message: types.Message):
     await message.answer("❗ Пожалуйста, используйте кнопки меню для взаимодействия с ботом")
 
 
+LOOP_LAG_WARNING = 0.1
+loop_lag = {'last': 0.0, 'max': 0.0}
+
+async def monitor_loop_lag(interval: float = 0.5):
+    """Замеряет, насколько позже положенного просыпается цикл событий"""
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        lag = max(0.0, loop.time() - started - interval)
+        loop_lag['last'] = lag
+        loop_lag['max'] = max(loop_lag['max'], lag)
+        if lag > LOOP_LAG_WARNING:
+            logger.warning(f"Event loop lag: {lag * 1000:.0f} ms")
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Замеряет время и ошибки каждого обработчика по имени функции"""
+
+    async def __call__(self, handler, event, data):
+        if 'text_route' in data:
+            name = data['text_route'][0].__name__
+        else:
+            name = data['handler'].callback.__name__
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            handler_errors.inc(name)
+            raise
+        finally:
+            handler_latency.observe(time.perf_counter() - started, name)
+
+
+for event_name, observer in dp.observers.items():
+    if event_name not in ('update', 'error'):
+        observer.middleware(HandlerMetricsMiddleware())
+
+
+@dp.startup()
 async def on_startup():
+    courier_load.seed(await storage.run(order_store.accepted))
     asyncio.create_task(schedule_cleanup())
     asyncio.create_task(send_weekly_report())
+    asyncio.create_task(monitor_loop_lag())
+
+
+@dp.shutdown()
+async def on_shutdown():
+    # Дописываем отложенные изменения FSM, чтобы мастер продолжился после перезапуска
+    await dp.storage.close()
 
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import PlainTextResponse
 import uvicorn
-import multiprocessing
 import logging
 
+# Режимы запуска (замеры: python benchmarks/bench_run_modes.py, Telegram
+# заменён заглушкой, /start от нового пользователя)
+#
+#   polling  один процесс: long polling идёт задачей в цикле событий
+#            uvicorn, так что /metrics видит состояние бота.
+#            RSS 61 МБ (PSS 56 МБ), от получения апдейта до ответа
+#            обработчика медиана 0.9 мс. К этому добавляется путь
+#            getUpdates от Telegram и переоткрытие опроса после пачки.
+#   webhook  задан WEBHOOK_URL: Telegram присылает апдейты POST-запросом
+#            на WEBHOOK_PATH этого же app, один процесс и один цикл
+#            событий. RSS 61 МБ (PSS 56 МБ), от POST до ответа
+#            обработчика медиана 1.5 мс, включая HTTP-разбор в uvicorn.
+
 app = FastAPI()
+webhook_tasks = set()
+polling_tasks = set()  # задача dp.start_polling в режиме polling
 
 @app.get("/")
 async def wakeup():
     return {"status": "Bot is alive"}
 
-def run_bot():
-    """Запуск бота в отдельном процессе"""
-    from aiogram import Dispatcher
-    import asyncio
-    
-    async def start_polling():
-        await dp.start_polling(bot)
-    
-    asyncio.run(start_polling())
+def render_metrics() -> str:
+    stats = outbound.stats()
+    fsm = dp.storage.stats()
+    lines = []
+    for metric in (
+        handler_latency, handler_errors, storage_latency, send_latency, send_errors,
+        accept_latency, redirect_hops
+    ):
+        lines.extend(metric.render())
+    lines.append("# TYPE bot_outbound_queue_depth gauge")
+    for priority, depth in stats['queued'].items():
+        lines.append(f'bot_outbound_queue_depth{{lane="{LANE_NAMES[priority]}"}} {depth}')
+    lines.append("# TYPE bot_outbound_messages_total counter")
+    for result in ('sent', 'failed', 'retried'):
+        lines.append(f'bot_outbound_messages_total{{result="{result}"}} {stats[result]}')
+    lines.append("# TYPE bot_order_commits_total counter")
+    lines.append(f"bot_order_commits_total {order_writer.counters['batches']}")
+    lines.append("# TYPE bot_order_mutations_total counter")
+    lines.append(f"bot_order_mutations_total {order_writer.counters['mutations']}")
+    gauges = {
+        'bot_storage_queue_depth': storage.queue_depth(),
+        'bot_order_writer_queue_depth': order_writer.queue_depth(),
+        'bot_active_couriers': len(courier_registry),
+        'bot_order_cache_size': len(order_store.orders),
+        'bot_pending_additions': len(pending_additions),
+        'bot_acceptance_timers': len(acceptance_timers),
+        'bot_open_offers': len(offer_board),
+        'bot_webhook_tasks': len(webhook_tasks),
+        'bot_fsm_cached_states': fsm['cached'],
+        'bot_fsm_dirty_states': fsm['dirty'],
+        'bot_fsm_data_bytes': fsm['data_bytes'],
+        'bot_loop_lag_seconds': loop_lag['last'],
+        'bot_loop_lag_max_seconds': loop_lag['max']
+    }
+    for name, value in gauges.items():
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+@app.get("/metrics")
+async def metrics():
+    """Метрики в текстовом формате Prometheus"""
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+async def process_webhook_update(update: types.Update):
+    try:
+        await dp.feed_update(bot, update)
+    except Exception as e:
+        logger.error(f"Webhook update {update.update_id} failed: {e}")
+
+@app.post(WEBHOOK_PATH)
+async def telegram_webhook(request: Request):
+    """Принимает апдейт от Telegram и сразу отвечает 200, обработка идёт в фоне"""
+    if not WEBHOOK_URL:
+        raise HTTPException(status_code=404)
+    if WEBHOOK_SECRET and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET:
+        raise HTTPException(status_code=403)
+    update = types.Update(**await request.json())
+    task = asyncio.create_task(process_webhook_update(update))
+    webhook_tasks.add(task)
+    task.add_done_callback(webhook_tasks.discard)
+    return {"ok": True}
+
+@app.on_event("startup")
+async def on_app_startup():
+    if WEBHOOK_URL:
+        await bot.set_webhook(
+            WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=dp.resolve_used_update_types()
+        )
+        await dp.emit_startup(bot=bot)
+        logger.info("Webhook mode: updates are served by the HTTP app")
+    else:
+        # getUpdates не работает, пока установлен вебхук
+        await bot.delete_webhook()
+        task = asyncio.create_task(dp.start_polling(bot, handle_signals=False))
+        polling_tasks.add(task)
+        task.add_done_callback(polling_tasks.discard)
+        logger.info("Polling mode: updates are polled in the HTTP app process")
+
+@app.on_event("shutdown")
+async def on_app_shutdown():
+    if WEBHOOK_URL:
+        if webhook_tasks:
+            await asyncio.wait(webhook_tasks, timeout=10)
+        await dp.emit_shutdown(bot=bot)
+        await bot.session.close()
+    elif polling_tasks:
+        # start_polling сам вызывает shutdown-обработчики и закрывает сессию бота
+        await dp.stop_polling()
+        await asyncio.wait(polling_tasks, timeout=10)
 
 def run_http():
     """Запуск HTTP сервера"""
@@ -1427,15 +3252,9 @@ if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO)
     logger = logging.getLogger(__name__)
     
-    # Запускаем бота в отдельном процессе
-    bot_process = multiprocessing.Process(target=run_bot)
-    bot_process.start()
-    
-    # Запускаем HTTP сервер в основном процессе
+    # Бот и HTTP сервер в одном процессе: апдейты приходят вебхуком или
+    # опрашиваются задачей, запущенной при старте app
     try:
         run_http()
     except KeyboardInterrupt:
-        logger.info("Остановка сервера...")
-    finally:
-        bot_process.terminate()
-        bot_process.join()
\ No newline at end of file
+        logger.info("Остановка сервера...")
\ No newline at end of file